@@ -1,47 +1,175 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 import sqlite3
 import asyncio
 from datetime import datetime
 import json
+import hashlib
+import time
 import os
+import sys
+import socket
+import gzip
+import shutil
+import tempfile
+import glob
+import functools
+import bisect
+import threading
 
 # Configurazione bot
 intents = discord.Intents.default()
-bot = commands.Bot(command_prefix='!', intents=intents)
+
+# Sharding: senza variabili discord.py sceglie il numero di shard; con SHARD_COUNT e
+# SHARD_IDS (es. "0,1") ogni processo gestisce solo i suoi shard sullo stesso database
+shard_count = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+shard_ids = [int(shard) for shard in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+if shard_ids is not None and shard_count is None:
+    # discord.py richiede shard_count insieme a shard_ids: meglio un messaggio chiaro che un ClientException
+    raise RuntimeError("SHARD_IDS richiede anche SHARD_COUNT (numero totale di shard di tutti i processi)")
+if shard_ids is not None and any(shard < 0 or shard >= shard_count for shard in shard_ids):
+    raise RuntimeError(f"SHARD_IDS deve contenere valori tra 0 e {shard_count - 1}")
+bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_count=shard_count, shard_ids=shard_ids)
+
+# Identifica questo processo quando si prende in carico lavoro condiviso (coda notifiche)
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Database: con PER_GUILD_DB=1 ogni gilda ha il suo file, altrimenti tutte condividono MAIN_DB
+MAIN_DB = 'pokemmo_marketplace.db'
+PER_GUILD_DB = os.getenv('PER_GUILD_DB') == '1'
+# Gilda a cui assegnare i dati creati prima della suddivisione per gilda: obbligatoria se ce ne sono,
+# senza la migrazione si ferma invece di spostarli in una gilda che nessuno vede
+LEGACY_GUILD_ID = int(os.getenv('LEGACY_GUILD_ID')) if os.getenv('LEGACY_GUILD_ID') else None
+
+# File già inizializzati da questo processo
+initialized_databases = set()
+
+def db_path(guild_id=None):
+    if PER_GUILD_DB and guild_id:
+        return f'pokemmo_marketplace_{guild_id}.db'
+    return MAIN_DB
+
+def connect_db(guild_id=None):
+    """Connessione al database della gilda (creato e migrato al primo utilizzo)"""
+    path = db_path(guild_id)
+    if path not in initialized_databases:
+        init_db(path)
+    return sqlite3.connect(path)
+
+def database_paths():
+    """Tutti i file database esistenti (uno solo se PER_GUILD_DB non è attivo)"""
+    paths = [MAIN_DB]
+    if PER_GUILD_DB:
+        paths += sorted(glob.glob('pokemmo_marketplace_*.db'))
+    return paths
+
+def create_guild_table(cursor, table, schema):
+    """Crea la tabella; se esiste senza guild_id la ricostruisce assegnando le righe a LEGACY_GUILD_ID"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    columns = [row[1] for row in cursor.fetchall()]
+    
+    if columns and 'guild_id' not in columns:
+        cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {table})')
+        if cursor.fetchone()[0] and LEGACY_GUILD_ID is None:
+            raise RuntimeError(f"La tabella {table} contiene dati senza gilda: imposta LEGACY_GUILD_ID "
+                               "con l'id della gilda a cui appartengono e riavvia")
+        column_list = ', '.join(columns)
+        cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+        cursor.execute(schema)
+        cursor.execute(f'''
+            INSERT INTO {table} (guild_id, {column_list})
+            SELECT ?, {column_list} FROM {table}_legacy
+        ''', (LEGACY_GUILD_ID or 0,))
+        # Mantiene il contatore AUTOINCREMENT: gli id di righe eliminate (ancora citati da ordini) non vanno riusati
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_sequence'")
+        if cursor.fetchone():
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (f'{table}_legacy',))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (row[0], table))
+                if cursor.rowcount == 0:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, row[0]))
+        cursor.execute(f'DROP TABLE {table}_legacy')
+        print(f"🔧 Tabella {table} migrata alla gilda {LEGACY_GUILD_ID or 0}")
+    else:
+        cursor.execute(schema)
+
+def add_column(cursor, table, column, definition):
+    """Aggiunge la colonna se la tabella è stata creata prima della sua introduzione"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# Reputazione fornitore (0-5): metà affidabilità (ordini completati sul totale), metà voto medio
+# dei clienti. Entrambe partono da un valore neutro con peso REPUTATION_PRIOR_WEIGHT ordini,
+# così pochi ordini non bastano a portare un fornitore in cima o in fondo alla classifica
+REPUTATION_PRIOR_WEIGHT = 5
+REPUTATION_PRIOR_RATE = 0.8
+REPUTATION_PRIOR_RATING = 3.5
+NEUTRAL_REPUTATION = 2.5 * REPUTATION_PRIOR_RATE + 0.5 * REPUTATION_PRIOR_RATING
+REPUTATION_SQL = f'''
+    2.5 * (completed_orders + {REPUTATION_PRIOR_WEIGHT * REPUTATION_PRIOR_RATE})
+        / (completed_orders + cancelled_orders + {REPUTATION_PRIOR_WEIGHT})
+    + 0.5 * (rating_sum + {REPUTATION_PRIOR_WEIGHT * REPUTATION_PRIOR_RATING})
+        / (rating_count + {REPUTATION_PRIOR_WEIGHT})
+'''
 
 # Inizializzazione database
-def init_db():
-    conn = sqlite3.connect('pokemmo_marketplace.db')
+def init_db(path=MAIN_DB):
+    conn = sqlite3.connect(path)
     cursor = conn.cursor()
     
-    # Tabella fornitori
-    cursor.execute('''
+    # WAL: più processi (shard) leggono mentre un altro scrive sullo stesso file
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # Le migrazioni rinominano tabelle: non riscrivere i riferimenti nelle altre tabelle
+    cursor.execute('PRAGMA legacy_alter_table=ON')
+    # La vista market_items viene ricreata in fondo con la definizione attuale
+    cursor.execute('DROP VIEW IF EXISTS market_items')
+    
+    # Tabella fornitori (con i contatori della reputazione, aggiornati ad ogni transizione d'ordine)
+    cursor.execute('PRAGMA table_info(suppliers)')
+    supplier_columns = [row[1] for row in cursor.fetchall()]
+    create_guild_table(cursor, 'suppliers', f'''
         CREATE TABLE IF NOT EXISTS suppliers (
-            user_id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
             username TEXT NOT NULL,
-            active BOOLEAN DEFAULT TRUE
+            active BOOLEAN DEFAULT TRUE,
+            completed_orders INTEGER NOT NULL DEFAULT 0,
+            cancelled_orders INTEGER NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            rating_count INTEGER NOT NULL DEFAULT 0,
+            reputation REAL NOT NULL DEFAULT {NEUTRAL_REPUTATION},
+            PRIMARY KEY (guild_id, user_id)
         )
     ''')
+    for column in ('completed_orders', 'cancelled_orders', 'rating_sum', 'rating_count'):
+        add_column(cursor, 'suppliers', column, 'INTEGER NOT NULL DEFAULT 0')
+    add_column(cursor, 'suppliers', 'reputation', f'REAL NOT NULL DEFAULT {NEUTRAL_REPUTATION}')
     
     # Tabella inventario
-    cursor.execute('''
+    create_guild_table(cursor, 'inventory', '''
         CREATE TABLE IF NOT EXISTS inventory (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
             supplier_id INTEGER,
             item_name TEXT NOT NULL,
+            item_key TEXT,
             quantity INTEGER NOT NULL,
             price INTEGER NOT NULL,
             description TEXT,
-            FOREIGN KEY (supplier_id) REFERENCES suppliers (user_id)
+            deleted_at INTEGER,
+            FOREIGN KEY (guild_id, supplier_id) REFERENCES suppliers (guild_id, user_id)
         )
     ''')
+    add_column(cursor, 'inventory', 'deleted_at', 'INTEGER')
     
     # Tabella ordini
-    cursor.execute('''
+    create_guild_table(cursor, 'orders', '''
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
             customer_id INTEGER NOT NULL,
             supplier_id INTEGER NOT NULL,
             item_id INTEGER NOT NULL,
@@ -51,48 +179,511 @@ def init_db():
             delivery_time TEXT NOT NULL,
             status TEXT DEFAULT 'pending',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            rating INTEGER,
+            item_name TEXT,
+            unit_price INTEGER,
+            supplier_name TEXT,
             FOREIGN KEY (item_id) REFERENCES inventory (id),
-            FOREIGN KEY (supplier_id) REFERENCES suppliers (user_id)
+            FOREIGN KEY (guild_id, supplier_id) REFERENCES suppliers (guild_id, user_id)
         )
     ''')
+    add_column(cursor, 'orders', 'rating', 'INTEGER')
+    # Copia di oggetto, prezzo e fornitore al momento dell'ordine: lo storico si legge senza JOIN
+    add_column(cursor, 'orders', 'item_name', 'TEXT')
+    add_column(cursor, 'orders', 'unit_price', 'INTEGER')
+    add_column(cursor, 'orders', 'supplier_name', 'TEXT')
+    cursor.execute('''
+        UPDATE orders SET
+            item_name = COALESCE((SELECT i.item_name FROM inventory i WHERE i.id = orders.item_id),
+                                 'Oggetto #' || orders.item_id),
+            unit_price = total_price / MAX(quantity, 1),
+            supplier_name = COALESCE((SELECT s.username FROM suppliers s
+                                      WHERE s.guild_id = orders.guild_id AND s.user_id = orders.supplier_id),
+                                     'User-' || orders.supplier_id)
+        WHERE item_name IS NULL
+    ''')
     
+    if supplier_columns and 'reputation' not in supplier_columns:
+        # Fornitori esistenti: contatori ricostruiti dagli ordini (chi ha annullato non era registrato)
+        cursor.execute('''
+            UPDATE suppliers SET
+                completed_orders = (SELECT COUNT(*) FROM orders o WHERE o.guild_id = suppliers.guild_id
+                                    AND o.supplier_id = suppliers.user_id AND o.status = 'completed'),
+                cancelled_orders = (SELECT COUNT(*) FROM orders o WHERE o.guild_id = suppliers.guild_id
+                                    AND o.supplier_id = suppliers.user_id AND o.status = 'cancelled')
+        ''')
+        cursor.execute(f'UPDATE suppliers SET reputation = {REPUTATION_SQL}')
+
+    # Storico prezzi (append-only): listini da add_item e scambi da ordini confermati
+    create_guild_table(cursor, 'price_events', '''
+        CREATE TABLE IF NOT EXISTS price_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            item_key TEXT NOT NULL,
+            item_name TEXT NOT NULL,
+            item_id INTEGER,
+            kind TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+    # Aggregati per oggetto e fascia temporale (ora/giorno/settimana)
+    create_guild_table(cursor, 'price_rollups', '''
+        CREATE TABLE IF NOT EXISTS price_rollups (
+            guild_id INTEGER NOT NULL,
+            item_key TEXT NOT NULL,
+            period TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            item_name TEXT NOT NULL,
+            min_price INTEGER NOT NULL,
+            median_price INTEGER NOT NULL,
+            last_price INTEGER NOT NULL,
+            last_at INTEGER NOT NULL,
+            volume INTEGER NOT NULL DEFAULT 0,
+            trades INTEGER NOT NULL DEFAULT 0,
+            observations INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, item_key, period, bucket_start)
+        )
+    ''')
+
+    # Istogramma prezzi per fascia: serve a mantenere la mediana senza rileggere lo storico
+    create_guild_table(cursor, 'price_rollup_counts', '''
+        CREATE TABLE IF NOT EXISTS price_rollup_counts (
+            guild_id INTEGER NOT NULL,
+            item_key TEXT NOT NULL,
+            period TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, item_key, period, bucket_start, price)
+        )
+    ''')
+
+    # Richieste d'acquisto permanenti (wishlist), indicizzate per nome oggetto
+    create_guild_table(cursor, 'wishlists', '''
+        CREATE TABLE IF NOT EXISTS wishlists (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            item_key TEXT NOT NULL,
+            item_name TEXT NOT NULL,
+            max_price INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (guild_id, user_id, item_key)
+        )
+    ''')
+
+    # Coda notifiche condivisa tra processi: ogni riga viene presa in carico da un solo processo
+    create_guild_table(cursor, 'notification_queue', '''
+        CREATE TABLE IF NOT EXISTS notification_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            claimed_by TEXT,
+            claimed_at INTEGER,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+    # Log eventi append-only: ogni variazione di inventario e transizione d'ordine
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'market_events'")
+    events_table_exists = cursor.fetchone() is not None
+    create_guild_table(cursor, 'market_events', '''
+        CREATE TABLE IF NOT EXISTS market_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            delta INTEGER NOT NULL DEFAULT 0,
+            data TEXT,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    if not events_table_exists:
+        # Database esistente: lo stato attuale diventa il punto di partenza del replay
+        cursor.execute('SELECT guild_id, id, supplier_id, item_name, quantity, price, description FROM inventory')
+        for guild_id, item_id, supplier_id, item_name, quantity, price, description in cursor.fetchall():
+            log_event(cursor, guild_id, 'inventory', item_id, 'snapshot', data={
+                'supplier_id': supplier_id, 'item_name': item_name, 'quantity': quantity,
+                'price': price, 'description': description,
+            })
+        cursor.execute('SELECT guild_id, id, customer_id, supplier_id, item_id, quantity, total_price, status FROM orders')
+        for guild_id, order_id, customer_id, supplier_id, item_id, quantity, total_price, status in cursor.fetchall():
+            log_event(cursor, guild_id, 'order', order_id, 'snapshot', data={
+                'customer_id': customer_id, 'supplier_id': supplier_id, 'item_id': item_id,
+                'quantity': quantity, 'total_price': total_price, 'status': status,
+            })
+
+    # Vetrina: messaggi catalogo aggiornati in un canale configurato per gilda
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS showcases (
+            guild_id INTEGER PRIMARY KEY,
+            channel_id INTEGER NOT NULL,
+            message_ids TEXT NOT NULL DEFAULT '[]'
+        )
+    ''')
+
+    # Nome normalizzato sull'inventario: raggruppa lo stesso oggetto tra fornitori diversi
+    cursor.execute('SELECT id, item_name FROM inventory WHERE item_key IS NULL')
+    cursor.executemany('UPDATE inventory SET item_key = ? WHERE id = ?',
+                       [(normalize_item_name(name), item_id) for item_id, name in cursor.fetchall()])
+
+    # Indici composti: ogni lettura è limitata a una gilda, quindi guild_id viene sempre per primo
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_item_price ON inventory (guild_id, item_key, price) WHERE quantity > 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_catalog ON inventory (guild_id, item_name) WHERE quantity > 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_supplier ON inventory (guild_id, supplier_id, item_name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders (guild_id, customer_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_supplier ON orders (guild_id, supplier_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (guild_id, status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_suppliers_reputation ON suppliers (guild_id, reputation DESC, user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_price_events_item ON price_events (guild_id, item_key, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_wishlists_item ON wishlists (guild_id, item_key, max_price)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_notification_queue_claim ON notification_queue (claimed_by, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_market_events_entity ON market_events (guild_id, entity, entity_id, id)')
+
+    # Vista aggregata per oggetto: prezzo minimo, quantità totale e numero di fornitori
+    # (letta per gilda e nome normalizzato tramite idx_inventory_item_price)
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS market_items AS
+        SELECT i.guild_id, i.item_key, MIN(i.item_name) AS item_name, MIN(i.price) AS min_price,
+               SUM(i.quantity) AS total_quantity, COUNT(DISTINCT i.supplier_id) AS suppliers
+        FROM inventory i
+        JOIN suppliers s ON i.guild_id = s.guild_id AND i.supplier_id = s.user_id
+        WHERE i.quantity > 0
+        GROUP BY i.guild_id, i.item_key
+    ''')
+
     conn.commit()
     conn.close()
+    initialized_databases.add(path)
+
+def update_reputation(cursor, guild_id, supplier_id, completed=0, cancelled=0, rating=None):
+    """Aggiorna i contatori del fornitore e ricalcola il punteggio; va chiamata nella transazione dell'ordine"""
+    cursor.execute('''
+        UPDATE suppliers SET
+            completed_orders = completed_orders + ?,
+            cancelled_orders = cancelled_orders + ?,
+            rating_sum = rating_sum + ?,
+            rating_count = rating_count + ?
+        WHERE guild_id = ? AND user_id = ?
+    ''', (completed, cancelled, rating or 0, 1 if rating else 0, guild_id, supplier_id))
+    cursor.execute(f'UPDATE suppliers SET reputation = {REPUTATION_SQL} WHERE guild_id = ? AND user_id = ?',
+                   (guild_id, supplier_id))
+
+def log_event(cursor, guild_id, entity, entity_id, event, delta=0, data=None):
+    """Aggiunge un evento al log; va chiamata nella stessa transazione della modifica"""
+    cursor.execute('''
+        INSERT INTO market_events (guild_id, entity, entity_id, event, delta, data, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (guild_id, entity, entity_id, event, delta, json.dumps(data) if data is not None else None, int(time.time())))
+
+def log_order_created(cursor, guild_id, order_id, customer_id, supplier_id, item_id, quantity, total_price):
+    """Eventi di un nuovo ordine: creazione e prenotazione della quantità"""
+    log_event(cursor, guild_id, 'order', order_id, 'created', data={
+        'customer_id': customer_id, 'supplier_id': supplier_id, 'item_id': item_id,
+        'quantity': quantity, 'total_price': total_price, 'status': 'pending',
+    })
+    log_event(cursor, guild_id, 'inventory', item_id, 'reserved', -quantity, {'order_id': order_id})
+
+def release_reservation(cursor, guild_id, item_id, quantity, order_id):
+    """Restituisce all'inventario la quantità di un ordine annullato, se l'oggetto non è stato rimosso"""
+    cursor.execute('UPDATE inventory SET quantity = quantity + ? WHERE id = ? AND deleted_at IS NULL', (quantity, item_id))
+    if cursor.rowcount:
+        log_event(cursor, guild_id, 'inventory', item_id, 'released', quantity, {'order_id': order_id})
+
+# Campi confrontati dal replay con le tabelle
+REPLAY_FIELDS = {
+    'inventory': ('supplier_id', 'item_name', 'quantity', 'price', 'description'),
+    'order': ('customer_id', 'supplier_id', 'item_id', 'quantity', 'total_price', 'status'),
+}
+
+def replay_events(path=MAIN_DB, guild_id=None):
+    """Ricostruisce inventario e ordini dagli eventi e li confronta con le tabelle; ritorna (eventi, differenze).
+    Con guild_id considera solo quella gilda (database condiviso)"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    guild_filter = '' if guild_id is None else 'WHERE guild_id = ?'
+    guild_params = () if guild_id is None else (guild_id,)
+    
+    state = {'inventory': {}, 'order': {}}
+    cursor.execute(f'SELECT entity, entity_id, event, delta, data FROM market_events {guild_filter} ORDER BY id', guild_params)
+    events = 0
+    for entity, entity_id, event, delta, data in cursor:
+        events += 1
+        data = json.loads(data) if data else {}
+        rows = state[entity]
+        if event in ('created', 'snapshot', 'restored'):
+            rows[entity_id] = data
+        elif event == 'removed':
+            rows.pop(entity_id, None)
+        elif entity == 'inventory':
+            row = rows.setdefault(entity_id, {'quantity': 0})
+            row['quantity'] = row.get('quantity', 0) + delta
+            if event == 'restocked':
+                row.update(data)
+        else:
+            rows.setdefault(entity_id, {}).update(data)
+    
+    live = {}
+    cursor.execute(f'SELECT id, supplier_id, item_name, quantity, price, description FROM inventory {guild_filter}', guild_params)
+    live['inventory'] = {row[0]: dict(zip(REPLAY_FIELDS['inventory'], row[1:])) for row in cursor.fetchall()}
+    cursor.execute(f'SELECT id, customer_id, supplier_id, item_id, quantity, total_price, status FROM orders {guild_filter}', guild_params)
+    live['order'] = {row[0]: dict(zip(REPLAY_FIELDS['order'], row[1:])) for row in cursor.fetchall()}
+    conn.close()
+    
+    diffs = []
+    for entity, fields in REPLAY_FIELDS.items():
+        replayed, current = state[entity], live[entity]
+        for entity_id in sorted(replayed.keys() | current.keys()):
+            if entity_id not in current:
+                diffs.append(f"{entity} #{entity_id}: presente negli eventi, assente nel database")
+            elif entity_id not in replayed:
+                diffs.append(f"{entity} #{entity_id}: presente nel database, assente negli eventi")
+            else:
+                for field in fields:
+                    if field in replayed[entity_id] and replayed[entity_id][field] != current[entity_id][field]:
+                        diffs.append(f"{entity} #{entity_id} {field}: eventi={replayed[entity_id][field]!r} database={current[entity_id][field]!r}")
+    
+    return events, diffs
+
+# Nome oggetto normalizzato (stessa chiave per "Leftovers" e " leftovers ")
+def normalize_item_name(name):
+    return ' '.join(name.split()).lower()
+
+# Fasce temporali degli aggregati prezzi (secondi)
+PRICE_PERIODS = {
+    'hour': 3600,
+    'day': 86400,
+    'week': 604800,
+}
+
+def price_bucket_start(period, ts):
+    """Inizio della fascia che contiene ts (le settimane partono dal lunedì)"""
+    size = PRICE_PERIODS[period]
+    # 01/01/1970 era giovedì: sposta di 3 giorni per allineare le settimane al lunedì
+    offset = 3 * 86400 if period == 'week' else 0
+    return (ts + offset) // size * size - offset
+
+def record_price_event(cursor, guild_id, item_id, item_name, kind, price, quantity):
+    """Registra un evento prezzo e aggiorna gli aggregati nella stessa transazione.
+
+    kind è 'listing' (add_item) o 'trade' (ordine confermato); il volume conta solo gli scambi.
+    """
+    item_key = normalize_item_name(item_name)
+    now = int(time.time())
+    volume = quantity if kind == 'trade' else 0
+    trades = 1 if kind == 'trade' else 0
+
+    cursor.execute('''
+        INSERT INTO price_events (guild_id, item_key, item_name, item_id, kind, price, quantity, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (guild_id, item_key, item_name, item_id, kind, price, quantity, now))
+
+    for period in PRICE_PERIODS:
+        bucket = price_bucket_start(period, now)
+
+        cursor.execute('''
+            INSERT INTO price_rollup_counts (guild_id, item_key, period, bucket_start, price, count)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT (guild_id, item_key, period, bucket_start, price) DO UPDATE SET count = count + 1
+        ''', (guild_id, item_key, period, bucket, price))
+
+        # Mediana (bassa) dall'istogramma della sola fascia corrente
+        cursor.execute('''
+            SELECT price, count FROM price_rollup_counts
+            WHERE guild_id = ? AND item_key = ? AND period = ? AND bucket_start = ?
+            ORDER BY price
+        ''', (guild_id, item_key, period, bucket))
+        histogram = cursor.fetchall()
+        target = (sum(count for _, count in histogram) - 1) // 2
+        median = histogram[-1][0]
+        for bucket_price, count in histogram:
+            if target < count:
+                median = bucket_price
+                break
+            target -= count
+
+        cursor.execute('''
+            INSERT INTO price_rollups (guild_id, item_key, period, bucket_start, item_name, min_price, median_price,
+                                       last_price, last_at, volume, trades, observations)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT (guild_id, item_key, period, bucket_start) DO UPDATE SET
+                item_name = excluded.item_name,
+                min_price = MIN(min_price, excluded.min_price),
+                median_price = excluded.median_price,
+                last_price = excluded.last_price,
+                last_at = excluded.last_at,
+                volume = volume + excluded.volume,
+                trades = trades + excluded.trades,
+                observations = observations + 1
+        ''', (guild_id, item_key, period, bucket, item_name, price, median, price, now, volume, trades))
+
+# Scadenze delle interazioni: Discord rifiuta la prima risposta dopo 3 secondi
+INTERACTION_DEADLINE = 3.0
+DEFER_BUDGET = float(os.getenv('DEFER_BUDGET', '2.0'))  # oltre questo tempo senza risposta si esegue il defer
+NEAR_MISS_MARGIN = 0.5                                  # risposte arrivate a meno di così dalla scadenza
+
+# Contatori mostrati in /stats
+deadline_metrics = {
+    'responded': 0,
+    'deferred': 0,
+    'near_miss': 0,
+    'missed': 0,
+}
+
+def interaction_age(interaction):
+    """Secondi trascorsi dalla creazione dell'interazione (dal suo snowflake)"""
+    return max(0.0, (discord.utils.utcnow() - interaction.created_at).total_seconds())
+
+class GuardedResponse:
+    """Sostituisce interaction.response: dopo un defer automatico i messaggi passano al followup"""
+    def __init__(self, interaction, ephemeral):
+        self._interaction = interaction
+        self._response = interaction.response
+        self._ephemeral = ephemeral
+        self._lock = asyncio.Lock()
+        self.acknowledged_at = None  # età dell'interazione alla prima risposta
+        self.auto_deferred = False
+        self.missed = False
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    async def _acknowledge(self, method, *args, **kwargs):
+        """Invia la prima risposta; ritorna False se l'interazione ha già risposto"""
+        async with self._lock:
+            if self._response.is_done():
+                return False
+            age = interaction_age(self._interaction)
+            await method(*args, **kwargs)
+            # Solo una risposta accettata da Discord conta come riconoscimento
+            self.acknowledged_at = age
+            return True
+
+    async def send_message(self, content=None, **kwargs):
+        if not await self._acknowledge(self._response.send_message, content, **kwargs):
+            # Webhook.send non accetta view=None (la risposta diretta sì)
+            if kwargs.get('view', ...) is None:
+                del kwargs['view']
+            await self._interaction.followup.send(content, **kwargs)
+
+    async def defer(self, **kwargs):
+        await self._acknowledge(self._response.defer, **kwargs)
+
+    async def auto_defer(self, delay):
+        await asyncio.sleep(delay)
+        # I comandi mostrano "sta pensando..."; i bottoni aggiornano il messaggio in silenzio
+        thinking = self._interaction.type == discord.InteractionType.application_command
+        try:
+            deferred = await self._acknowledge(self._response.defer, ephemeral=self._ephemeral, thinking=thinking)
+        except discord.HTTPException as e:
+            # Il task non è atteso da nessuno: l'errore (di solito token scaduto) va contato qui
+            self.missed = True
+            deadline_metrics['missed'] += 1
+            print(f"❌ Defer automatico fallito ({interaction_name(self._interaction)}) dopo {interaction_age(self._interaction):.2f}s: {e}")
+            return
+        if deferred:
+            self.auto_deferred = True
+            deadline_metrics['deferred'] += 1
+            print(f"⏳ Defer automatico dopo {self.acknowledged_at:.2f}s ({interaction_name(self._interaction)})")
+
+def interaction_name(interaction):
+    if interaction.command is not None:
+        return f"/{interaction.command.qualified_name}"
+    return (interaction.data or {}).get('custom_id', 'interazione')
+
+def deadline_guard(ephemeral=True):
+    """Decoratore per comandi e bottoni: esegue il defer se il gestore non risponde entro
+    DEFER_BUDGET e conta le risposte arrivate vicino o oltre la scadenza.
+    ephemeral decide la visibilità della risposta quando il defer è automatico."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            interaction = next(arg for arg in args if isinstance(arg, discord.Interaction))
+            guard = GuardedResponse(interaction, ephemeral)
+            interaction._cs_response = guard
+            
+            # Se l'interazione è già in ritardo (coda, loop occupato) il defer parte subito
+            watchdog = asyncio.create_task(guard.auto_defer(max(0.0, DEFER_BUDGET - interaction_age(interaction))))
+            try:
+                await func(*args, **kwargs)
+            except discord.NotFound as e:
+                if e.code != 10062:  # Unknown interaction: il token è già scaduto
+                    raise
+                if guard.missed:  # già contata dal defer automatico
+                    return
+                deadline_metrics['missed'] += 1
+                print(f"❌ Scadenza interazione superata ({interaction_name(interaction)}): {interaction_age(interaction):.2f}s")
+                return
+            finally:
+                watchdog.cancel()
+            
+            if guard.acknowledged_at is None:
+                return
+            deadline_metrics['responded'] += 1
+            if guard.acknowledged_at > INTERACTION_DEADLINE:
+                deadline_metrics['missed'] += 1
+            elif guard.acknowledged_at > INTERACTION_DEADLINE - NEAR_MISS_MARGIN:
+                deadline_metrics['near_miss'] += 1
+                print(f"⚠️ Risposta a {guard.acknowledged_at:.2f}s dalla creazione ({interaction_name(interaction)})")
+        return wrapper
+    return decorator
 
 # Classe per i bottoni del fornitore (DM)
+# I bottoni non vivono in memoria: il custom_id contiene l'ordine e on_interaction
+# ricrea la view, così qualsiasi shard/processo può gestire il click
 class SupplierOrderView(discord.ui.View):
-    def __init__(self, order_id: int, customer_id: int):
-        super().__init__(timeout=604800)  # 7 giorni timeout
+    def __init__(self, order_id: int, customer_id: int, guild_id: int):
+        super().__init__(timeout=None)
         self.order_id = order_id
         self.customer_id = customer_id
+        self.guild_id = guild_id
+        self.confirm_order.custom_id = f'order:supplier:confirm_order:{guild_id}:{order_id}'
+        self.cancel_order.custom_id = f'order:supplier:cancel_order:{guild_id}:{order_id}'
+        self.stop()  # Non registrare la view nel processo corrente
 
     @discord.ui.button(label='✅ Conferma Ordine', style=discord.ButtonStyle.green)
+    @deadline_guard()
     async def confirm_order(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer()
         
-        conn = sqlite3.connect('pokemmo_marketplace.db')
+        conn = connect_db(self.guild_id)
         cursor = conn.cursor()
         
         try:
             # Verifica che l'ordine esista e sia pending
             cursor.execute('''
-                SELECT o.customer_id, i.item_name, o.quantity, o.total_price, s.username
-                FROM orders o
-                JOIN inventory i ON o.item_id = i.id  
-                JOIN suppliers s ON o.supplier_id = s.user_id
-                WHERE o.id = ? AND o.supplier_id = ? AND o.status = 'pending'
-            ''', (self.order_id, interaction.user.id))
+                SELECT customer_id, item_id, item_name, quantity, total_price, supplier_name, unit_price
+                FROM orders
+                WHERE guild_id = ? AND id = ? AND supplier_id = ? AND status = 'pending'
+            ''', (self.guild_id, self.order_id, interaction.user.id))
             
             order_data = cursor.fetchone()
             if not order_data:
                 await interaction.followup.send("❌ Ordine non trovato o già processato.", ephemeral=True)
                 return
             
-            customer_id, item_name, quantity, total_price, supplier_name = order_data
+            customer_id, item_id, item_name, quantity, total_price, supplier_name, unit_price = order_data
             
-            # Aggiorna status a completed
-            cursor.execute('UPDATE orders SET status = \'completed\' WHERE id = ?', (self.order_id,))
+            # Aggiorna status a completed (solo se ancora pending: un altro shard può averlo già gestito)
+            cursor.execute('UPDATE orders SET status = \'completed\' WHERE id = ? AND status = \'pending\'', (self.order_id,))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                await interaction.followup.send("❌ Ordine non trovato o già processato.", ephemeral=True)
+                return
+            
+            log_event(cursor, self.guild_id, 'order', self.order_id, 'status', data={'status': 'completed', 'from': 'pending', 'by': 'supplier'})
+            update_reputation(cursor, self.guild_id, interaction.user.id, completed=1)
+            
+            # Registra lo scambio nello storico prezzi (prezzo unitario)
+            record_price_event(cursor, self.guild_id, item_id, item_name, 'trade', unit_price, quantity)
             conn.commit()
+            state_engine.refresh(cursor, self.guild_id, suppliers=[interaction.user.id])
             
             # Aggiorna il messaggio del fornitore
             embed = discord.Embed(
@@ -121,9 +712,9 @@ class SupplierOrderView(discord.ui.View):
                 customer_embed.add_field(name="Oggetto", value=f"{item_name} x{quantity}", inline=True)
                 customer_embed.add_field(name="Fornitore", value=supplier_name, inline=True)
                 customer_embed.add_field(name="Totale", value=f"{total_price:,} ¥", inline=True)
-                customer_embed.set_footer(text="Grazie per aver usato PokeMMO Marketplace!")
+                customer_embed.set_footer(text="Valuta il fornitore (facoltativo) - Grazie per aver usato PokeMMO Marketplace!")
                 
-                await customer.send(embed=customer_embed)
+                await customer.send(embed=customer_embed, view=RatingView(self.order_id, customer_id, self.guild_id))
                 print(f"✅ Notifica completamento inviata al cliente {customer_id}")
                 
             except Exception as e:
@@ -139,21 +730,20 @@ class SupplierOrderView(discord.ui.View):
             conn.close()
 
     @discord.ui.button(label='❌ Annulla Ordine', style=discord.ButtonStyle.red)
+    @deadline_guard()
     async def cancel_order(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer()
         
-        conn = sqlite3.connect('pokemmo_marketplace.db')
+        conn = connect_db(self.guild_id)
         cursor = conn.cursor()
         
         try:
             # Verifica che l'ordine esista e sia pending
             cursor.execute('''
-                SELECT o.customer_id, o.item_id, o.quantity, i.item_name, o.total_price, s.username
-                FROM orders o
-                JOIN inventory i ON o.item_id = i.id
-                JOIN suppliers s ON o.supplier_id = s.user_id  
-                WHERE o.id = ? AND o.supplier_id = ? AND o.status = 'pending'
-            ''', (self.order_id, interaction.user.id))
+                SELECT customer_id, item_id, quantity, item_name, total_price, supplier_name
+                FROM orders
+                WHERE guild_id = ? AND id = ? AND supplier_id = ? AND status = 'pending'
+            ''', (self.guild_id, self.order_id, interaction.user.id))
             
             order_data = cursor.fetchone()
             if not order_data:
@@ -162,13 +752,22 @@ class SupplierOrderView(discord.ui.View):
             
             customer_id, item_id, quantity, item_name, total_price, supplier_name = order_data
             
-            # Annulla l'ordine
-            cursor.execute('UPDATE orders SET status = \'cancelled\' WHERE id = ?', (self.order_id,))
+            # Annulla l'ordine (solo se ancora pending: un altro shard può averlo già gestito)
+            cursor.execute('UPDATE orders SET status = \'cancelled\' WHERE id = ? AND status = \'pending\'', (self.order_id,))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                await interaction.followup.send("❌ Ordine non trovato o già processato.", ephemeral=True)
+                return
             
+            log_event(cursor, self.guild_id, 'order', self.order_id, 'status', data={'status': 'cancelled', 'from': 'pending', 'by': 'supplier'})
             # Ripristina l'inventario
-            cursor.execute('UPDATE inventory SET quantity = quantity + ? WHERE id = ?', (quantity, item_id))
+            release_reservation(cursor, self.guild_id, item_id, quantity, self.order_id)
+            # Solo gli annullamenti del fornitore pesano sulla sua reputazione
+            update_reputation(cursor, self.guild_id, interaction.user.id, cancelled=1)
             
             conn.commit()
+            state_engine.refresh(cursor, self.guild_id, items=[item_id], suppliers=[interaction.user.id])
+            mark_showcase_dirty(self.guild_id)
             
             # Aggiorna il messaggio del fornitore
             embed = discord.Embed(
@@ -215,27 +814,29 @@ class SupplierOrderView(discord.ui.View):
 
 # Classe per i bottoni del cliente
 class CustomerOrderView(discord.ui.View):
-    def __init__(self, order_id: int, supplier_id: int):
-        super().__init__(timeout=604800)  # 7 giorni timeout
+    def __init__(self, order_id: int, supplier_id: int, guild_id: int):
+        super().__init__(timeout=None)
         self.order_id = order_id
         self.supplier_id = supplier_id
+        self.guild_id = guild_id
+        self.cancel_order.custom_id = f'order:customer:cancel_order:{guild_id}:{order_id}'
+        self.stop()  # Non registrare la view nel processo corrente
 
     @discord.ui.button(label='❌ Annulla Ordine', style=discord.ButtonStyle.red)
+    @deadline_guard()
     async def cancel_order(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer()
         
-        conn = sqlite3.connect('pokemmo_marketplace.db')
+        conn = connect_db(self.guild_id)
         cursor = conn.cursor()
         
         try:
             # Verifica che l'ordine appartenga al cliente e sia pending
             cursor.execute('''
-                SELECT o.supplier_id, o.item_id, o.quantity, i.item_name, o.total_price, s.username
-                FROM orders o
-                JOIN inventory i ON o.item_id = i.id
-                JOIN suppliers s ON o.supplier_id = s.user_id
-                WHERE o.id = ? AND o.customer_id = ? AND o.status = 'pending'
-            ''', (self.order_id, interaction.user.id))
+                SELECT supplier_id, item_id, quantity, item_name, total_price, supplier_name
+                FROM orders
+                WHERE guild_id = ? AND id = ? AND customer_id = ? AND status = 'pending'
+            ''', (self.guild_id, self.order_id, interaction.user.id))
             
             order_data = cursor.fetchone()
             if not order_data:
@@ -244,13 +845,20 @@ class CustomerOrderView(discord.ui.View):
             
             supplier_id, item_id, quantity, item_name, total_price, supplier_name = order_data
             
-            # Annulla l'ordine
-            cursor.execute('UPDATE orders SET status = \'cancelled\' WHERE id = ?', (self.order_id,))
+            # Annulla l'ordine (solo se ancora pending: un altro shard può averlo già gestito)
+            cursor.execute('UPDATE orders SET status = \'cancelled\' WHERE id = ? AND status = \'pending\'', (self.order_id,))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                await interaction.followup.send("❌ Ordine non trovato o già processato.", ephemeral=True)
+                return
             
+            log_event(cursor, self.guild_id, 'order', self.order_id, 'status', data={'status': 'cancelled', 'from': 'pending', 'by': 'customer'})
             # Ripristina l'inventario
-            cursor.execute('UPDATE inventory SET quantity = quantity + ? WHERE id = ?', (quantity, item_id))
+            release_reservation(cursor, self.guild_id, item_id, quantity, self.order_id)
             
             conn.commit()
+            state_engine.refresh(cursor, self.guild_id, items=[item_id])
+            mark_showcase_dirty(self.guild_id)
             
             # Conferma annullamento al cliente
             embed = discord.Embed(
@@ -296,7 +904,7 @@ class CustomerOrderView(discord.ui.View):
             conn.close()
 
 # Funzione per inviare DM al fornitore con bottoni
-async def send_supplier_notification_with_buttons(order_id, supplier_id, supplier_name, item_name, quantita, total_price, luogo, orario, customer):
+async def send_supplier_notification_with_buttons(guild_id, order_id, supplier_id, supplier_name, item_name, quantita, total_price, luogo, orario, customer):
     """Invia notifica DM al fornitore con bottoni interattivi"""
     dm_sent = False
     dm_error = None
@@ -319,10 +927,13 @@ async def send_supplier_notification_with_buttons(order_id, supplier_id, supplie
         supplier_embed.add_field(name="Luogo consegna", value=luogo, inline=True)
         supplier_embed.add_field(name="Orario richiesto", value=orario, inline=True)
         supplier_embed.add_field(name="Contatto Discord", value=f"<@{customer.id}>", inline=False)
+        guild = bot.get_guild(guild_id)
+        if guild:
+            supplier_embed.add_field(name="Server", value=guild.name, inline=False)
         supplier_embed.set_footer(text="Usa i bottoni sotto per gestire l'ordine")
         
         # Crea i bottoni per il fornitore
-        view = SupplierOrderView(order_id, customer.id)
+        view = SupplierOrderView(order_id, customer.id, guild_id)
         
         await supplier.send(embed=supplier_embed, view=view)
         dm_sent = True
@@ -340,36 +951,1216 @@ async def send_supplier_notification_with_buttons(order_id, supplier_id, supplie
         dm_error = f"Errore HTTP Discord: {e}"
         print(f"❌ DEBUG: Errore HTTP inviando DM: {e}")
         
-    except Exception as e:
-        dm_error = f"Errore generico: {e}"
-        print(f"❌ DEBUG: Errore generico inviando DM: {e}")
+    except Exception as e:
+        dm_error = f"Errore generico: {e}"
+        print(f"❌ DEBUG: Errore generico inviando DM: {e}")
+    
+    return dm_sent, dm_error
+
+def match_wishlists(cursor, guild_id, item_id, item_name, price, quantity, supplier_id, supplier_name):
+    """Accoda nella notification_queue una notifica per ogni wishlist che corrisponde all'annuncio"""
+    cursor.execute('''
+        SELECT user_id FROM wishlists
+        WHERE guild_id = ? AND item_key = ? AND (max_price IS NULL OR max_price >= ?) AND user_id != ?
+    ''', (guild_id, normalize_item_name(item_name), price, supplier_id))
+
+    matches = cursor.fetchall()
+    payload = json.dumps([item_id, item_name, price, quantity, supplier_name])
+    now = int(time.time())
+    cursor.executemany('''
+        INSERT INTO notification_queue (guild_id, user_id, kind, payload, created_at)
+        VALUES (?, ?, 'wishlist', ?, ?)
+    ''', [(guild_id, user_id, payload, now) for (user_id,) in matches])
+    return len(matches)
+
+# Dopo quanto tempo una notifica presa in carico da un processo morto torna disponibile
+NOTIFICATION_CLAIM_TIMEOUT = 300
+
+def claim_notifications(path, kind, limit=500):
+    """Prende in carico un lotto di notifiche per questo processo e le raggruppa per utente"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    now = int(time.time())
+    claim = f"{PROCESS_ID}:{time.monotonic_ns()}"
+    
+    cursor.execute('''
+        UPDATE notification_queue SET claimed_by = ?, claimed_at = ?
+        WHERE id IN (
+            SELECT id FROM notification_queue
+            WHERE kind = ? AND (claimed_by IS NULL OR claimed_at < ?)
+            ORDER BY id
+            LIMIT ?
+        )
+    ''', (claim, now, kind, now - NOTIFICATION_CLAIM_TIMEOUT, limit))
+    conn.commit()
+    
+    cursor.execute('''
+        SELECT id, guild_id, user_id, payload FROM notification_queue
+        WHERE claimed_by = ?
+        ORDER BY id
+    ''', (claim,))
+    
+    batch = {}
+    for notification_id, guild_id, user_id, payload in cursor.fetchall():
+        ids, payloads = batch.setdefault(user_id, ([], []))
+        ids.append(notification_id)
+        payloads.append([guild_id] + json.loads(payload))
+    
+    conn.close()
+    return batch
+
+def complete_notifications(path, notification_ids):
+    conn = sqlite3.connect(path)
+    conn.executemany('DELETE FROM notification_queue WHERE id = ?', [(i,) for i in notification_ids])
+    conn.commit()
+    conn.close()
+
+@tasks.loop(seconds=15)
+async def flush_wishlist_notifications():
+    """Invia un solo DM per utente con tutti gli annunci accumulati"""
+    for path in database_paths():
+        batch = claim_notifications(path, 'wishlist')
+        for user_id, (notification_ids, listings) in batch.items():
+            await send_wishlist_notification(user_id, listings)
+            # Anche in caso di errore (DM bloccati) la notifica non viene ritentata
+            complete_notifications(path, notification_ids)
+
+async def send_wishlist_notification(user_id, listings):
+    try:
+        user = await bot.fetch_user(user_id)
+        embed = discord.Embed(
+            title="🔔 Disponibili oggetti dalla tua lista desideri!",
+            color=discord.Color.gold(),
+            timestamp=datetime.now()
+        )
+        # Un embed ha al massimo 25 campi: tiene gli annunci più recenti
+        for guild_id, item_id, item_name, price, quantity, supplier_name in listings[-25:]:
+            guild = bot.get_guild(guild_id)
+            value = f"**Fornitore:** {supplier_name}\n**Disponibili:** {quantity}\n**Prezzo:** {price:,} ¥"
+            if guild:
+                value += f"\n**Server:** {guild.name}"
+            embed.add_field(name=f"#{item_id} - {item_name}", value=value, inline=False)
+        embed.set_footer(text="Usa /negozio ordina con l'ID dell'oggetto per acquistare")
+
+        await user.send(embed=embed)
+        print(f"✅ Notifica wishlist inviata a {user_id} ({len(listings)} annunci)")
+
+    except Exception as e:
+        print(f"❌ Errore notifica wishlist {user_id}: {e}")
+
+# Classe per i bottoni di valutazione inviati al cliente dopo la conferma (DM)
+class RatingView(discord.ui.View):
+    def __init__(self, order_id: int, customer_id: int, guild_id: int):
+        super().__init__(timeout=None)
+        self.order_id = order_id
+        self.customer_id = customer_id
+        self.guild_id = guild_id
+        for stars in range(1, 6):
+            getattr(self, f'rate_{stars}').custom_id = f'order:rating:rate_{stars}:{guild_id}:{order_id}'
+        self.stop()  # Non registrare la view nel processo corrente
+
+    async def rate(self, interaction: discord.Interaction, stars: int):
+        await interaction.response.defer()
+        
+        conn = connect_db(self.guild_id)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                SELECT supplier_id FROM orders
+                WHERE guild_id = ? AND id = ? AND customer_id = ? AND status = 'completed'
+            ''', (self.guild_id, self.order_id, interaction.user.id))
+            order_data = cursor.fetchone()
+            
+            # Un solo voto per ordine, anche con click ripetuti o da più shard
+            if order_data:
+                cursor.execute('UPDATE orders SET rating = ? WHERE id = ? AND rating IS NULL', (stars, self.order_id))
+            if not order_data or cursor.rowcount == 0:
+                await interaction.followup.send("❌ Ordine già valutato o non valutabile.", ephemeral=True)
+                return
+            
+            log_event(cursor, self.guild_id, 'order', self.order_id, 'rated', data={'rating': stars})
+            update_reputation(cursor, self.guild_id, order_data[0], rating=stars)
+            conn.commit()
+            state_engine.refresh(cursor, self.guild_id, suppliers=[order_data[0]])
+            
+            await interaction.edit_original_response(view=None)
+            await interaction.followup.send(f"⭐ Grazie! Hai valutato l'ordine #{self.order_id} con {'⭐' * stars}", ephemeral=True)
+            
+        except Exception as e:
+            print(f"❌ Errore valutazione ordine: {e}")
+            conn.rollback()
+            await interaction.followup.send("❌ Errore durante la valutazione.", ephemeral=True)
+            
+        finally:
+            cursor.close()
+            conn.close()
+
+    @discord.ui.button(label='1 ⭐', style=discord.ButtonStyle.grey)
+    @deadline_guard()
+    async def rate_1(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.rate(interaction, 1)
+
+    @discord.ui.button(label='2 ⭐', style=discord.ButtonStyle.grey)
+    @deadline_guard()
+    async def rate_2(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.rate(interaction, 2)
+
+    @discord.ui.button(label='3 ⭐', style=discord.ButtonStyle.grey)
+    @deadline_guard()
+    async def rate_3(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.rate(interaction, 3)
+
+    @discord.ui.button(label='4 ⭐', style=discord.ButtonStyle.grey)
+    @deadline_guard()
+    async def rate_4(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.rate(interaction, 4)
+
+    @discord.ui.button(label='5 ⭐', style=discord.ButtonStyle.grey)
+    @deadline_guard()
+    async def rate_5(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.rate(interaction, 5)
+
+# View con bottoni ordine, indicizzate per il secondo campo del custom_id
+ORDER_BUTTON_VIEWS = {
+    'supplier': SupplierOrderView,
+    'customer': CustomerOrderView,
+    'rating': RatingView,
+}
+
+@bot.event
+async def on_interaction(interaction: discord.Interaction):
+    """Gestisce i click sui bottoni ordine, anche per ordini creati da un altro shard"""
+    if interaction.type != discord.InteractionType.component:
+        return
+    
+    parts = (interaction.data or {}).get('custom_id', '').split(':')
+    if len(parts) == 4 and LEGACY_GUILD_ID is not None:
+        # Bottoni inviati prima della suddivisione per gilda
+        parts.insert(3, str(LEGACY_GUILD_ID))
+    if len(parts) != 5 or parts[0] != 'order' or parts[1] not in ORDER_BUTTON_VIEWS:
+        return
+    
+    _, view_name, action, guild_id, order_id = parts
+    view = ORDER_BUTTON_VIEWS[view_name](int(order_id), 0, int(guild_id))
+    button = getattr(view, action, None)
+    if isinstance(button, discord.ui.Button):
+        await button.callback(interaction)
+
+# Hash dell'ultimo albero comandi sincronizzato, per applicazione e destinazione (globale o gilda)
+COMMAND_HASH_FILE = 'command_tree.hash'
+
+# Metriche di avvio mostrate in /stats
+startup_metrics = {
+    'connect_started': {},  # shard_id -> inizio dell'ultima connessione non ancora pronta
+    'connect_to_ready': None,
+    'connect_shard': None,
+    'command_sync': None,
+}
+
+def command_tree_hash(guild=None):
+    """Hash dei comandi serializzati (gruppi fornitore/negozio e comandi principali)"""
+    payload = sorted((command.to_dict() for command in bot.tree.get_commands(guild=guild)),
+                     key=lambda command: command['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_command_tree():
+    """Sincronizza i comandi solo se sono cambiati dall'ultima sincronizzazione"""
+    # Modalità sviluppo: sincronizzazione istantanea su una sola gilda
+    dev_guild_id = os.getenv('DEV_GUILD_ID')
+    guild = discord.Object(id=int(dev_guild_id)) if dev_guild_id else None
+    if guild:
+        bot.tree.copy_global_to(guild=guild)
+    
+    target = f"{bot.application_id}:{guild.id if guild else 'global'}"
+    current_hash = command_tree_hash(guild)
+    
+    try:
+        with open(COMMAND_HASH_FILE) as f:
+            stored_hashes = json.load(f)
+    except (OSError, ValueError):
+        stored_hashes = {}
+    
+    if stored_hashes.get(target) == current_hash and not os.getenv('FORCE_COMMAND_SYNC'):
+        startup_metrics['command_sync'] = 'invariati'
+        print(f"⏭️ Comandi slash invariati ({target}), sincronizzazione saltata.")
+        return
+    
+    try:
+        synced = await bot.tree.sync(guild=guild)
+        print(f"✅ Sincronizzati {len(synced)} comandi slash ({target}).")
+    except Exception as e:
+        startup_metrics['command_sync'] = 'errore'
+        print(f"❌ Errore nella sincronizzazione: {e}")
+        return
+    
+    stored_hashes[target] = current_hash
+    with open(COMMAND_HASH_FILE, 'w') as f:
+        json.dump(stored_hashes, f)
+    startup_metrics['command_sync'] = 'sincronizzati'
+
+@bot.event
+async def setup_hook():
+    # Eseguito una sola volta per processo, non ad ogni riconnessione al gateway
+    init_db()
+    if STATE_ENGINE and shard_ids is not None:
+        print("⚠️ STATE_ENGINE ignorato: con più processi le scritture degli altri shard non sarebbero visibili")
+    elif STATE_ENGINE:
+        started = time.perf_counter()
+        listings = await asyncio.to_thread(state_engine.load_all)
+        print(f"🧠 Stato in memoria: {listings} annunci caricati in {time.perf_counter() - started:.2f}s")
+    await sync_command_tree()
+
+@bot.event
+async def on_ready():
+    print(f'🎮 {bot.user} è online e pronto!')
+    print(f'📊 Connesso a {len(bot.guilds)} server(s) con {len(bot.shards)} shard')
+    
+    if not flush_wishlist_notifications.is_running():
+        flush_wishlist_notifications.start()
+    if not refresh_showcases.is_running():
+        refresh_showcases.start()
+    # Con più processi i backup programmati li fa solo quello dello shard 0
+    if not scheduled_backup.is_running() and (shard_ids is None or 0 in shard_ids):
+        scheduled_backup.start()
+    if not consistency_check.is_running() and (shard_ids is None or 0 in shard_ids):
+        consistency_check.start()
+
+# Letture condivise: richieste identiche concorrenti aspettano la stessa query
+inflight_reads = {}
+# Ultimo risultato per chiave, restituito agli utenti che superano il limite di richieste
+read_cache = {}
+# Token bucket per utente: user_id -> (token, ultimo aggiornamento)
+read_buckets = {}
+
+READ_THROTTLE_BURST = 3     # richieste consecutive consentite
+READ_THROTTLE_RATE = 0.2    # token recuperati al secondo
+
+def take_read_token(user_id):
+    now = time.monotonic()
+    tokens, last = read_buckets.get(user_id, (READ_THROTTLE_BURST, now))
+    tokens = min(READ_THROTTLE_BURST, tokens + (now - last) * READ_THROTTLE_RATE)
+    if tokens < 1:
+        read_buckets[user_id] = (tokens, now)
+        return False
+    read_buckets[user_id] = (tokens - 1, now)
+    return True
+
+async def single_flight(key, loader):
+    """Esegue loader in un thread; le chiamate con la stessa chiave in corso ne condividono il risultato"""
+    task = inflight_reads.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(loader))
+        inflight_reads[key] = task
+        task.add_done_callback(lambda _: inflight_reads.pop(key, None))
+    
+    # shield: se un'interazione viene annullata le altre continuano ad aspettare
+    result = await asyncio.shield(task)
+    read_cache[key] = result
+    return result
+
+async def throttled_read(key, user_id, loader):
+    """Ritorna (risultato, da_cache): oltre il limite l'utente riceve l'ultimo risultato in cache"""
+    if not take_read_token(user_id) and key in read_cache:
+        return read_cache[key], True
+    return await single_flight(key, loader), False
+
+# Ordinamenti del catalogo; per reputazione scorre idx_suppliers_reputation e poi gli oggetti di ogni fornitore
+CATALOG_ORDERS = {
+    'nome': 'i.item_name',
+    'prezzo': 'i.price, i.item_name',
+    'reputazione': 's.reputation DESC, s.user_id, i.item_name',
+}
+
+# Stato in memoria (STATE_ENGINE=1): inventario e fornitori in record compatti, per servire catalogo,
+# inventario e autocompletamento senza SQLite. Caricato all'avvio e aggiornato dopo ogni scrittura
+# rileggendo per chiave le righe modificate. Solo con un processo: gli altri shard non lo aggiornerebbero
+STATE_ENGINE = os.getenv('STATE_ENGINE') == '1'
+
+class Listing:
+    __slots__ = ('id', 'supplier_id', 'item_name', 'item_key', 'quantity', 'price', 'description')
+
+    def __init__(self, item_id, supplier_id, item_name, item_key, quantity, price, description):
+        self.id = item_id
+        self.supplier_id = supplier_id
+        # Stesso oggetto venduto da più fornitori: una sola copia delle stringhe
+        self.item_name = sys.intern(item_name)
+        self.item_key = sys.intern(item_key)
+        self.quantity = quantity
+        self.price = price
+        self.description = description
+
+class SupplierRecord:
+    __slots__ = ('user_id', 'username', 'reputation')
+
+    def __init__(self, user_id, username, reputation):
+        self.user_id = user_id
+        self.username = username
+        self.reputation = reputation
+
+class GuildMarket:
+    """Annunci di una gilda con gli indici ordinati usati dalle letture"""
+    __slots__ = ('listings', 'suppliers', 'name_index', 'by_supplier', 'by_item', 'key_index')
+
+    def __init__(self):
+        self.listings = {}      # id -> Listing (anche a quantità 0, esclusi gli eliminati)
+        self.suppliers = {}     # user_id -> SupplierRecord
+        self.name_index = []    # (item_name, id) ordinati come ORDER BY item_name
+        self.by_supplier = {}   # supplier_id -> (item_name, id) ordinati
+        self.by_item = {}       # item_key -> set di id
+        self.key_index = []     # item_key ordinati, per la ricerca per prefisso
+
+    def add(self, listing):
+        entry = (listing.item_name, listing.id)
+        self.listings[listing.id] = listing
+        bisect.insort(self.name_index, entry)
+        bisect.insort(self.by_supplier.setdefault(listing.supplier_id, []), entry)
+        ids = self.by_item.setdefault(listing.item_key, set())
+        if not ids:
+            bisect.insort(self.key_index, listing.item_key)
+        ids.add(listing.id)
+
+    def remove(self, item_id):
+        listing = self.listings.pop(item_id, None)
+        if listing is None:
+            return
+        entry = (listing.item_name, listing.id)
+        self.name_index.pop(bisect.bisect_left(self.name_index, entry))
+        supplier_entries = self.by_supplier[listing.supplier_id]
+        supplier_entries.pop(bisect.bisect_left(supplier_entries, entry))
+        ids = self.by_item[listing.item_key]
+        ids.discard(item_id)
+        if not ids:
+            del self.by_item[listing.item_key]
+            self.key_index.pop(bisect.bisect_left(self.key_index, listing.item_key))
+
+class StateEngine:
+    def __init__(self):
+        self.enabled = False
+        self.markets = {}        # guild_id -> GuildMarket
+        self.loaded_paths = set()
+        self.lock = threading.RLock()  # scritture dai thread del database, letture dal loop
+
+    def load(self, path):
+        """Carica tutte le gilde di un file database; ritorna il numero di annunci"""
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        markets = {}
+        cursor.execute('SELECT guild_id, user_id, username, reputation FROM suppliers')
+        for guild_id, user_id, username, reputation in cursor:
+            markets.setdefault(guild_id, GuildMarket()).suppliers[user_id] = SupplierRecord(user_id, username, reputation)
+        
+        cursor.execute('''
+            SELECT guild_id, id, supplier_id, item_name, item_key, quantity, price, description
+            FROM inventory
+            WHERE deleted_at IS NULL
+            ORDER BY guild_id, item_name, id
+        ''')
+        count = 0
+        for guild_id, *row in cursor:
+            market = markets.setdefault(guild_id, GuildMarket())
+            listing = Listing(*row)
+            # Righe già ordinate per nome: append invece di insort
+            entry = (listing.item_name, listing.id)
+            market.listings[listing.id] = listing
+            market.name_index.append(entry)
+            market.by_supplier.setdefault(listing.supplier_id, []).append(entry)
+            market.by_item.setdefault(listing.item_key, set()).add(listing.id)
+            count += 1
+        conn.close()
+        
+        for market in markets.values():
+            market.key_index = sorted(market.by_item)
+        with self.lock:
+            self.markets.update(markets)
+            self.loaded_paths.add(path)
+        return count
+
+    def load_all(self):
+        count = sum(self.load(path) for path in database_paths())
+        self.enabled = True
+        return count
+
+    def market(self, guild_id):
+        with self.lock:
+            if db_path(guild_id) not in self.loaded_paths:
+                # PER_GUILD_DB: file della gilda caricato al primo accesso
+                connect_db(guild_id).close()
+                self.load(db_path(guild_id))
+            return self.markets.setdefault(guild_id, GuildMarket())
+
+    def refresh(self, cursor, guild_id, items=(), suppliers=()):
+        """Rilegge per chiave le righe appena scritte (dopo il commit, con la stessa connessione)"""
+        if not self.enabled or db_path(guild_id) not in self.loaded_paths:
+            return  # Il file verrà caricato già aggiornato al primo accesso
+        
+        # Lettura e applicazione sotto lo stesso lock: l'ultima riga applicata è sempre l'ultima letta,
+        # anche con scritture concorrenti dal loop e dai thread del database
+        with self.lock:
+            item_rows = {}
+            for item_id in set(items):
+                cursor.execute('''
+                    SELECT id, supplier_id, item_name, item_key, quantity, price, description
+                    FROM inventory WHERE id = ? AND guild_id = ? AND deleted_at IS NULL
+                ''', (item_id, guild_id))
+                item_rows[item_id] = cursor.fetchone()
+            supplier_rows = {}
+            for supplier_id in set(suppliers):
+                cursor.execute('SELECT user_id, username, reputation FROM suppliers WHERE guild_id = ? AND user_id = ?',
+                               (guild_id, supplier_id))
+                supplier_rows[supplier_id] = cursor.fetchone()
+            
+            market = self.markets.setdefault(guild_id, GuildMarket())
+            for item_id, row in item_rows.items():
+                current = market.listings.get(item_id)
+                if row is None:
+                    market.remove(item_id)
+                elif current is not None and (current.item_name, current.item_key, current.supplier_id) == (row[2], row[3], row[1]):
+                    current.quantity, current.price, current.description = row[4], row[5], row[6]
+                else:
+                    market.remove(item_id)
+                    market.add(Listing(*row))
+            for supplier_id, row in supplier_rows.items():
+                if row is None:
+                    market.suppliers.pop(supplier_id, None)
+                else:
+                    market.suppliers[supplier_id] = SupplierRecord(*row)
+
+    def catalog(self, guild_id, order='nome'):
+        """Stesse righe di load_catalog_items"""
+        with self.lock:
+            market = self.market(guild_id)
+            entries = []
+            for _, item_id in market.name_index:
+                listing = market.listings[item_id]
+                supplier = market.suppliers.get(listing.supplier_id)
+                if listing.quantity > 0 and supplier is not None:
+                    entries.append((listing, supplier))
+            # sort stabile: a parità resta l'ordine per nome
+            if order == 'prezzo':
+                entries.sort(key=lambda entry: entry[0].price)
+            elif order == 'reputazione':
+                entries.sort(key=lambda entry: (-entry[1].reputation, entry[1].user_id))
+            return [(listing.id, listing.item_name, listing.quantity, listing.price, listing.description,
+                     supplier.username, supplier.reputation) for listing, supplier in entries]
+
+    def supplier_inventory(self, guild_id, supplier_id):
+        """Stesse righe di load_supplier_inventory"""
+        with self.lock:
+            market = self.market(guild_id)
+            rows = []
+            for _, item_id in market.by_supplier.get(supplier_id, ()):
+                listing = market.listings[item_id]
+                if listing.quantity > 0:
+                    rows.append((listing.id, listing.item_name, listing.quantity, listing.price, listing.description))
+            return rows
+
+    def item_suggestions(self, guild_id, prefix, limit=25):
+        """Stessi nomi di load_item_suggestions"""
+        prefix = normalize_item_name(prefix)
+        with self.lock:
+            market = self.market(guild_id)
+            names = []
+            for key in market.key_index[bisect.bisect_left(market.key_index, prefix):]:
+                if not key.startswith(prefix) or len(names) >= limit:
+                    break
+                available = [market.listings[item_id].item_name for item_id in market.by_item[key]
+                             if market.listings[item_id].quantity > 0]
+                if available:
+                    names.append(min(available))
+            return names
+
+state_engine = StateEngine()
+
+def load_catalog_items(guild_id, order='nome'):
+    if state_engine.enabled:
+        return state_engine.catalog(guild_id, order)
+    
+    conn = connect_db(guild_id)
+    cursor = conn.cursor()
+    
+    cursor.execute(f'''
+        SELECT i.id, i.item_name, i.quantity, i.price, i.description, s.username, s.reputation
+        FROM inventory i
+        JOIN suppliers s ON i.guild_id = s.guild_id AND i.supplier_id = s.user_id
+        WHERE i.guild_id = ? AND i.quantity > 0
+        ORDER BY {CATALOG_ORDERS[order]}
+    ''', (guild_id,))
+    
+    items = cursor.fetchall()
+    conn.close()
+    return items
+
+def build_catalog_embed(guild_id, order='nome'):
+    items = load_catalog_items(guild_id, order)
+    
+    if not items:
+        return None
+    
+    embed = discord.Embed(
+        title="🏪 Catalogo PokeMMO Marketplace",
+        color=discord.Color.gold()
+    )
+    
+    for item_id, name, qty, price, desc, supplier, reputation in items:
+        value = f"**Fornitore:** {supplier} (⭐ {reputation:.1f})\n**Disponibili:** {qty}\n**Prezzo:** {price:,} ¥"
+        if desc:
+            value += f"\n**Descrizione:** {desc}"
+        embed.add_field(name=f"#{item_id} - {name}", value=value, inline=False)
+    
+    return embed
+
+def load_market_items(guild_id):
+    conn = connect_db(guild_id)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT item_name, min_price, total_quantity, suppliers
+        FROM market_items
+        WHERE guild_id = ?
+        ORDER BY item_key
+    ''', (guild_id,))
+    items = cursor.fetchall()
+    conn.close()
+    return items
+
+def build_market_embed(guild_id):
+    """Catalogo raggruppato per oggetto: totale disponibile tra i fornitori e prezzo più basso"""
+    items = load_market_items(guild_id)
+    
+    if not items:
+        return None
+    
+    embed = discord.Embed(
+        title="🏪 Catalogo per oggetto",
+        color=discord.Color.gold()
+    )
+    
+    for name, min_price, total_qty, suppliers in items[:25]:
+        value = f"**Disponibili:** {total_qty} da {suppliers} fornitore/i\n**Prezzo minimo:** {min_price:,} ¥"
+        embed.add_field(name=name, value=value, inline=False)
+    
+    embed.set_footer(text="Compra al miglior prezzo con /negozio compra")
+    return embed
+
+# Vetrina: al massimo un aggiornamento ogni SHOWCASE_DEBOUNCE secondi, qualunque sia il numero di modifiche
+SHOWCASE_DEBOUNCE = 5
+SHOWCASE_PAGE_SIZE = 20
+SHOWCASE_MAX_PAGES = 5
+# Ricontrollo periodico anche senza modifiche locali (scritture fatte da altri processi)
+SHOWCASE_RESYNC = 60
+
+showcase_state = {
+    'dirty': set(),     # gilde con inventario modificato dall'ultimo aggiornamento
+    'last_refresh': 0.0,
+    'last_pages': {},  # guild_id -> pagine pubblicate, per evitare modifiche inutili
+}
+
+def mark_showcase_dirty(guild_id):
+    """Da chiamare dopo ogni scrittura sull'inventario della gilda"""
+    showcase_state['dirty'].add(guild_id)
+
+def build_showcase_pages(items):
+    pages = []
+    max_items = SHOWCASE_PAGE_SIZE * SHOWCASE_MAX_PAGES
+    shown = items[:max_items]
+    total_pages = max(1, -(-len(shown) // SHOWCASE_PAGE_SIZE))
+    
+    for page in range(total_pages):
+        embed = discord.Embed(
+            title=f"🏪 Vetrina PokeMMO Marketplace ({page + 1}/{total_pages})",
+            color=discord.Color.gold()
+        )
+        for item_id, name, qty, price, desc, supplier, reputation in shown[page * SHOWCASE_PAGE_SIZE:(page + 1) * SHOWCASE_PAGE_SIZE]:
+            value = f"**Fornitore:** {supplier} (⭐ {reputation:.1f})\n**Disponibili:** {qty}\n**Prezzo:** {price:,} ¥"
+            if desc:
+                # Descrizioni accorciate per restare nel limite di 6000 caratteri per embed
+                value += f"\n**Descrizione:** {desc[:100]}"
+            embed.add_field(name=f"#{item_id} - {name}", value=value, inline=False)
+        pages.append(embed)
+    
+    if not items:
+        pages[0].description = "Nessun oggetto disponibile al momento."
+    elif len(items) > max_items:
+        pages[-1].set_footer(text=f"... e altri {len(items) - max_items} oggetti: usa /negozio catalogo")
+    else:
+        pages[-1].set_footer(text="Ordina con /negozio ordina")
+    
+    return pages
+
+def save_showcase_messages(guild_id, message_ids):
+    conn = connect_db()
+    conn.execute('UPDATE showcases SET message_ids = ? WHERE guild_id = ?', (json.dumps(message_ids), guild_id))
+    conn.commit()
+    conn.close()
+
+async def update_showcase(guild_id, channel, message_ids, pages):
+    """Modifica sul posto i messaggi della vetrina, creando o eliminando quelli in più"""
+    page_dicts = [page.to_dict() for page in pages]
+    if showcase_state['last_pages'].get(guild_id) == page_dicts and len(message_ids) == len(pages):
+        return
+    
+    new_ids = []
+    for index, page in enumerate(pages):
+        message = None
+        if index < len(message_ids):
+            try:
+                message = await channel.get_partial_message(message_ids[index]).edit(embed=page)
+            except discord.NotFound:
+                message = None
+        if message is None:
+            message = await channel.send(embed=page)
+            if index == 0:
+                try:
+                    await message.pin()
+                except discord.HTTPException as e:
+                    print(f"❌ Errore pin vetrina: {e}")
+        new_ids.append(message.id)
+    
+    for message_id in message_ids[len(pages):]:
+        try:
+            await channel.get_partial_message(message_id).delete()
+        except discord.HTTPException:
+            pass
+    
+    if new_ids != message_ids:
+        save_showcase_messages(guild_id, new_ids)
+    showcase_state['last_pages'][guild_id] = page_dicts
+
+@tasks.loop(seconds=SHOWCASE_DEBOUNCE)
+async def refresh_showcases():
+    now = time.monotonic()
+    resync = now - showcase_state['last_refresh'] >= SHOWCASE_RESYNC
+    dirty = showcase_state['dirty']
+    if not dirty and not resync:
+        return
+    showcase_state['dirty'] = set()
+    if resync:
+        showcase_state['last_refresh'] = now
+    
+    # La configurazione delle vetrine sta sempre nel database principale
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT guild_id, channel_id, message_ids FROM showcases')
+    showcases = cursor.fetchall()
+    conn.close()
+    
+    for guild_id, channel_id, message_ids in showcases:
+        if not resync and guild_id not in dirty:
+            continue
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            continue  # Gilda gestita da un altro shard/processo
+        try:
+            pages = build_showcase_pages(await asyncio.to_thread(load_catalog_items, guild_id))
+            await update_showcase(guild_id, channel, json.loads(message_ids), pages)
+        except Exception as e:
+            print(f"❌ Errore aggiornamento vetrina {guild_id}: {e}")
+
+# Backup online: copia a piccoli passi con l'API di backup di SQLite, in un thread separato
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_KEEP_MANUAL = int(os.getenv('BACKUP_KEEP_MANUAL', '3'))  # /backup ha una rotazione separata
+if BACKUP_KEEP < 1 or BACKUP_KEEP_MANUAL < 1:
+    raise RuntimeError("BACKUP_KEEP e BACKUP_KEEP_MANUAL devono essere almeno 1")
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '6'))
+BACKUP_GZIP = os.getenv('BACKUP_GZIP', '1') == '1'
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.01  # pausa tra i passi: le scritture degli handler non restano bloccate
+
+backup_lock = asyncio.Lock()
+
+def verify_backup(path):
+    """Apre la copia (decompressa se .gz) in sola lettura ed esegue PRAGMA integrity_check"""
+    check_path = path
+    temp_path = None
+    try:
+        if path.endswith('.gz'):
+            with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_file, gzip.open(path, 'rb') as source:
+                shutil.copyfileobj(source, temp_file)
+                temp_path = check_path = temp_file.name
+        
+        conn = sqlite3.connect(f'file:{check_path}?mode=ro', uri=True)
+        try:
+            rows = conn.execute('PRAGMA integrity_check').fetchall()
+        finally:
+            conn.close()
+        
+        return rows == [('ok',)], '; '.join(row[0] for row in rows[:5])
+    
+    except (OSError, sqlite3.Error) as e:
+        return False, str(e)
+    
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+
+def rotate_backups(prefix, keep):
+    """Tiene solo gli ultimi keep backup (i nomi contengono il timestamp e si ordinano)"""
+    backups = sorted(name for name in os.listdir(BACKUP_DIR)
+                     if name.startswith(prefix) and name.endswith(('.db', '.db.gz')))
+    for name in backups[:-keep]:
+        os.remove(os.path.join(BACKUP_DIR, name))
+
+def run_backup(database=MAIN_DB, compress=BACKUP_GZIP, manual=False):
+    """Esegue backup, compressione, verifica e rotazione; ritorna (percorso, dimensione, ok, dettaglio).
+    I backup manuali hanno prefisso e rotazione propri: non sostituiscono quelli programmati"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    prefix = ('manuale-' if manual else '') + os.path.splitext(os.path.basename(database))[0] + '-'
+    path = os.path.join(BACKUP_DIR, f"{prefix}{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    
+    source = sqlite3.connect(database)
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP)
+        # La copia eredita la modalità WAL: la riporta a un file unico e autosufficiente
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+    
+    if compress:
+        with open(path, 'rb') as raw, gzip.open(path + '.gz', 'wb') as compressed:
+            shutil.copyfileobj(raw, compressed)
+        os.remove(path)
+        path += '.gz'
+    
+    size = os.path.getsize(path)
+    ok, detail = verify_backup(path)
+    rotate_backups(prefix, BACKUP_KEEP_MANUAL if manual else BACKUP_KEEP)
+    return path, size, ok, detail
+
+async def backup_database(database=MAIN_DB, manual=False):
+    async with backup_lock:
+        path, size, ok, detail = await asyncio.to_thread(run_backup, database, BACKUP_GZIP, manual)
+    if ok:
+        print(f"✅ Backup completato: {path} ({size:,} byte)")
+    else:
+        print(f"❌ Backup {path} non valido: {detail}")
+    return path, size, ok, detail
+
+@tasks.loop(hours=BACKUP_INTERVAL_HOURS)
+async def scheduled_backup():
+    for database in database_paths():
+        try:
+            await backup_database(database)
+        except Exception as e:
+            print(f"❌ Errore backup programmato {database}: {e}")
+
+# Verifica di coerenza tra inventario e ordini: scansione a lotti per id, una breve transazione per lotto
+VERIFY_BATCH = 500
+VERIFY_INTERVAL_MINUTES = float(os.getenv('VERIFY_INTERVAL_MINUTES', '30'))
+VERIFY_AUTOFIX = os.getenv('VERIFY_AUTOFIX', '1') == '1'  # 0: il job segnala soltanto (dry-run)
+ORDER_PENDING_DAYS = int(os.getenv('ORDER_PENDING_DAYS', '7'))  # oltre, un ordine in attesa viene segnalato
+
+# Ultimo controllo del job per file: path -> (timestamp, anomalie)
+verify_reports = {}
+
+def restore_deleted_item(cursor, guild_id, item_id, supplier_id, unit_price):
+    """Ricrea come eliminata (quantità 0) una riga inventario cancellata ma ancora citata da ordini"""
+    cursor.execute('''
+        SELECT data FROM market_events
+        WHERE guild_id = ? AND entity = 'inventory' AND entity_id = ? AND event IN ('created', 'snapshot')
+        ORDER BY id DESC
+        LIMIT 1
+    ''', (guild_id, item_id))
+    row = cursor.fetchone()
+    data = json.loads(row[0]) if row and row[0] else {}
+    item_name = data.get('item_name') or f"Oggetto #{item_id}"
+    price = data.get('price', unit_price)
+    
+    cursor.execute('''
+        INSERT OR IGNORE INTO inventory (id, guild_id, supplier_id, item_name, item_key, quantity, price, description, deleted_at)
+        VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)
+    ''', (item_id, guild_id, supplier_id, item_name, normalize_item_name(item_name), price, data.get('description'), int(time.time())))
+    if cursor.rowcount:
+        log_event(cursor, guild_id, 'inventory', item_id, 'restored', data={
+            'supplier_id': supplier_id, 'item_name': item_name, 'quantity': 0,
+            'price': price, 'description': data.get('description'),
+        })
+    return cursor.rowcount > 0
+
+def verify_database(path=MAIN_DB, fix=False, guild_id=None):
+    """Cerca quantità negative, annunci senza fornitore, ordini su oggetti eliminati e ordini in attesa
+    orfani o vecchi; con fix=True corregge tutto tranne i vecchi, che restano alle parti.
+    Ritorna [(guild_id, descrizione, corretta)]"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    anomalies = []
+    guild_filter = '' if guild_id is None else 'AND {}.guild_id = ?'
+    guild_params = () if guild_id is None else (guild_id,)
+    
+    # Inventario: quantità negative e annunci di fornitori non registrati
+    last_id = 0
+    while True:
+        cursor.execute(f'''
+            SELECT i.id, i.guild_id, i.supplier_id, i.quantity, s.user_id IS NULL AND i.deleted_at IS NULL
+            FROM inventory i
+            LEFT JOIN suppliers s ON i.guild_id = s.guild_id AND i.supplier_id = s.user_id
+            WHERE i.id > ? {guild_filter.format('i')}
+            ORDER BY i.id
+            LIMIT ?
+        ''', (last_id, *guild_params, VERIFY_BATCH))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        
+        touched = []
+        for item_id, item_guild, supplier_id, quantity, supplier_missing in rows:
+            if quantity < 0:
+                fixed = False
+                if fix:
+                    cursor.execute('UPDATE inventory SET quantity = 0 WHERE id = ? AND quantity = ?', (item_id, quantity))
+                    fixed = cursor.rowcount > 0
+                    if fixed:
+                        log_event(cursor, item_guild, 'inventory', item_id, 'adjusted', -quantity, {'reason': 'verifica'})
+                        touched.append((item_guild, item_id))
+                anomalies.append((item_guild, f"Inventario #{item_id}: quantità {quantity} (riportata a 0)", fixed))
+            if supplier_missing:
+                fixed = False
+                if fix:
+                    cursor.execute('SELECT quantity FROM inventory WHERE id = ? AND deleted_at IS NULL', (item_id,))
+                    row = cursor.fetchone()
+                    if row:
+                        cursor.execute('UPDATE inventory SET quantity = 0, deleted_at = ? WHERE id = ?', (int(time.time()), item_id))
+                        log_event(cursor, item_guild, 'inventory', item_id, 'deleted', -row[0], {'reason': 'verifica'})
+                        touched.append((item_guild, item_id))
+                        fixed = True
+                anomalies.append((item_guild, f"Inventario #{item_id}: fornitore {supplier_id} non registrato (nascosto)", fixed))
+        conn.commit()
+        for item_guild, item_id in touched:
+            state_engine.refresh(cursor, item_guild, items=[item_id])
+    
+    # Ordini: oggetti eliminati e ordini in attesa senza oggetto, senza fornitore o troppo vecchi
+    missing_items = set()
+    last_id = 0
+    while True:
+        cursor.execute(f'''
+            SELECT o.id, o.guild_id, o.supplier_id, o.item_id, o.quantity, o.unit_price, o.status,
+                   i.id IS NULL, s.user_id IS NULL, o.created_at < datetime('now', ?)
+            FROM orders o
+            LEFT JOIN inventory i ON o.item_id = i.id
+            LEFT JOIN suppliers s ON o.guild_id = s.guild_id AND o.supplier_id = s.user_id
+            WHERE o.id > ? {guild_filter.format('o')}
+            ORDER BY o.id
+            LIMIT ?
+        ''', (f'-{ORDER_PENDING_DAYS} days', last_id, *guild_params, VERIFY_BATCH))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        
+        touched = []
+        for order_id, order_guild, supplier_id, item_id, quantity, unit_price, status, item_missing, supplier_missing, stale in rows:
+            if item_missing and item_id not in missing_items:
+                missing_items.add(item_id)
+                fixed = fix and restore_deleted_item(cursor, order_guild, item_id, supplier_id, unit_price)
+                anomalies.append((order_guild, f"Ordine #{order_id}: oggetto #{item_id} eliminato (ripristinato come rimosso)", fixed))
+            if status != 'pending' or not (item_missing or supplier_missing or stale):
+                continue
+            
+            reason = ("oggetto eliminato" if item_missing else
+                      "fornitore non registrato" if supplier_missing else
+                      f"in attesa da oltre {ORDER_PENDING_DAYS} giorni")
+            if not (item_missing or supplier_missing):
+                # Fornitore e cliente possono ancora concluderlo: si segnala senza annullare
+                anomalies.append((order_guild, f"Ordine #{order_id} in attesa: {reason} (solo segnalato)", False))
+                continue
+            fixed = False
+            if fix:
+                # Annullamento neutro per la reputazione; la quantità torna disponibile se l'oggetto esiste
+                cursor.execute('UPDATE orders SET status = \'cancelled\' WHERE id = ? AND status = \'pending\'', (order_id,))
+                fixed = cursor.rowcount > 0
+                if fixed:
+                    log_event(cursor, order_guild, 'order', order_id, 'status',
+                              data={'status': 'cancelled', 'from': 'pending', 'by': 'verifica'})
+                    release_reservation(cursor, order_guild, item_id, quantity, order_id)
+                    touched.append((order_guild, item_id))
+            anomalies.append((order_guild, f"Ordine #{order_id} in attesa: {reason} (annullato)", fixed))
+        conn.commit()
+        for order_guild, item_id in touched:
+            state_engine.refresh(cursor, order_guild, items=[item_id])
+    
+    conn.close()
+    return anomalies
+
+async def run_verifier(path, fix, guild_id=None):
+    anomalies = await asyncio.to_thread(verify_database, path, fix, guild_id)
+    for anomaly_guild in {anomaly[0] for anomaly in anomalies if anomaly[2]}:
+        mark_showcase_dirty(anomaly_guild)
+    return anomalies
+
+@tasks.loop(minutes=VERIFY_INTERVAL_MINUTES)
+async def consistency_check():
+    for path in database_paths():
+        try:
+            anomalies = await run_verifier(path, VERIFY_AUTOFIX)
+        except Exception as e:
+            print(f"❌ Errore verifica coerenza {path}: {e}")
+            continue
+        verify_reports[path] = (int(time.time()), anomalies)
+        if anomalies:
+            fixed = sum(1 for anomaly in anomalies if anomaly[2])
+            print(f"🩺 Verifica {path}: {len(anomalies)} anomalie, {fixed} corrette")
+
+# Lavoro sul database dei comandi fornitore, eseguito in un thread per non bloccare il loop
+# (così il defer automatico può scattare anche con il database lento)
+def save_inventory_item(guild_id, supplier_id, supplier_name, nome, quantita, prezzo, descrizione):
+    """Aggiunge o aggiorna un oggetto (quantita negativa riduce la scorta, mai sotto zero);
+    ritorna (quantità precedente o None, nuova quantità), None se non fornitore,
+    False se l'oggetto è nuovo e quantita non è positiva"""
+    conn = connect_db(guild_id)
+    cursor = conn.cursor()
+    
+    # Verifica se è registrato come fornitore
+    cursor.execute('SELECT user_id FROM suppliers WHERE guild_id = ? AND user_id = ?', (guild_id, supplier_id))
+    if not cursor.fetchone():
+        conn.close()
+        return None
+    
+    # Blocca le scritture: una prenotazione concorrente non deve finire tra lettura e aggiornamento
+    cursor.execute('BEGIN IMMEDIATE')
+    
+    # Controlla se l'oggetto esiste già per questo fornitore (stesso nome normalizzato usato da /negozio compra)
+    cursor.execute('''
+        SELECT id, quantity, price, description 
+        FROM inventory 
+        WHERE guild_id = ? AND supplier_id = ? AND item_key = ? AND deleted_at IS NULL
+    ''', (guild_id, supplier_id, normalize_item_name(nome)))
+    
+    existing_item = cursor.fetchone()
+    
+    if existing_item:
+        # Oggetto esiste già - aggiorna quantità (relativa, come le prenotazioni) e prezzo
+        item_id, current_qty, current_price, current_desc = existing_item
+        
+        cursor.execute('''
+            UPDATE inventory 
+            SET quantity = MAX(quantity + ?, 0), price = ?, description = ?
+            WHERE id = ?
+        ''', (quantita, prezzo, descrizione or current_desc, item_id))
+        cursor.execute('SELECT quantity FROM inventory WHERE id = ?', (item_id,))
+        new_quantity = cursor.fetchone()[0]
+        log_event(cursor, guild_id, 'inventory', item_id, 'restocked', new_quantity - current_qty,
+                  {'price': prezzo, 'description': descrizione or current_desc})
+    elif quantita <= 0:
+        conn.rollback()
+        conn.close()
+        return False
+    else:
+        # Nuovo oggetto - crea entry
+        cursor.execute('''
+            INSERT INTO inventory (guild_id, supplier_id, item_name, item_key, quantity, price, description)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (guild_id, supplier_id, nome, normalize_item_name(nome), quantita, prezzo, descrizione))
+        item_id = cursor.lastrowid
+        current_qty, new_quantity = None, quantita
+        log_event(cursor, guild_id, 'inventory', item_id, 'created', data={
+            'supplier_id': supplier_id, 'item_name': nome, 'quantity': quantita,
+            'price': prezzo, 'description': descrizione,
+        })
+    
+    if quantita > 0 and new_quantity > 0:
+        # Registra il prezzo di listino nello storico
+        record_price_event(cursor, guild_id, item_id, nome, 'listing', prezzo, quantita)
+        
+        # Avvisa chi ha l'oggetto in lista desideri (notifiche inviate a lotti); non per riduzioni
+        # o cambi di solo prezzo
+        match_wishlists(cursor, guild_id, item_id, nome, prezzo, new_quantity, supplier_id, supplier_name)
     
-    return dm_sent, dm_error
+    conn.commit()
+    state_engine.refresh(cursor, guild_id, items=[item_id])
+    conn.close()
+    return current_qty, new_quantity
 
-@bot.event
-async def on_ready():
-    print(f'🎮 {bot.user} è online e pronto!')
-    print(f'📊 Connesso a {len(bot.guilds)} server(s)')
-    init_db()
-    try:
-        synced = await bot.tree.sync()
-        print(f"✅ Sincronizzati {len(synced)} comandi slash.")
-    except Exception as e:
-        print(f"❌ Errore nella sincronizzazione: {e}")
+def delete_inventory_item(guild_id, supplier_id, item_id):
+    """Soft-delete: la riga resta per gli ordini che la citano, ma esce da catalogo e inventario.
+    Ritorna False se l'oggetto non esiste o non è del fornitore"""
+    conn = connect_db(guild_id)
+    cursor = conn.cursor()
+    
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('SELECT quantity FROM inventory WHERE guild_id = ? AND id = ? AND supplier_id = ? AND deleted_at IS NULL',
+                  (guild_id, item_id, supplier_id))
+    row = cursor.fetchone()
+    if not row:
+        conn.rollback()
+        conn.close()
+        return False
+    
+    cursor.execute('UPDATE inventory SET quantity = 0, deleted_at = ? WHERE id = ?', (int(time.time()), item_id))
+    log_event(cursor, guild_id, 'inventory', item_id, 'deleted', -row[0])
+    conn.commit()
+    state_engine.refresh(cursor, guild_id, items=[item_id])
+    conn.close()
+    return True
+
+def load_supplier_inventory(guild_id, supplier_id):
+    if state_engine.enabled:
+        return state_engine.supplier_inventory(guild_id, supplier_id)
+    
+    conn = connect_db(guild_id)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT id, item_name, quantity, price, description 
+        FROM inventory 
+        WHERE guild_id = ? AND supplier_id = ? AND quantity > 0
+        ORDER BY item_name
+    ''', (guild_id, supplier_id))
+    
+    items = cursor.fetchall()
+    conn.close()
+    return items
+
+def load_received_orders(guild_id, supplier_id):
+    """Ultimi ordini ricevuti dal fornitore, None se non è registrato"""
+    conn = connect_db(guild_id)
+    cursor = conn.cursor()
+    
+    # Verifica che sia un fornitore registrato
+    cursor.execute('SELECT user_id FROM suppliers WHERE guild_id = ? AND user_id = ?', (guild_id, supplier_id))
+    if not cursor.fetchone():
+        conn.close()
+        return None
+    
+    cursor.execute('''
+        SELECT id, item_name, quantity, total_price, location, 
+               delivery_time, status, created_at, customer_id
+        FROM orders
+        WHERE guild_id = ? AND supplier_id = ?
+        ORDER BY created_at DESC
+        LIMIT 15
+    ''', (guild_id, supplier_id))
+    
+    orders = cursor.fetchall()
+    conn.close()
+    return orders
+
+def load_item_suggestions(guild_id, prefix, limit=25):
+    """Nomi degli oggetti disponibili che iniziano con prefix (intervallo su idx_inventory_item_price)"""
+    prefix = normalize_item_name(prefix)
+    conn = connect_db(guild_id)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT MIN(item_name)
+        FROM inventory
+        WHERE guild_id = ? AND quantity > 0 AND item_key >= ? AND item_key < ?
+        GROUP BY item_key
+        ORDER BY item_key
+        LIMIT ?
+    ''', (guild_id, prefix, prefix + '\U0010ffff', limit))
+    
+    names = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return names
+
+async def item_name_autocomplete(interaction: discord.Interaction, current: str):
+    if state_engine.enabled:
+        names = state_engine.item_suggestions(interaction.guild_id, current)
+    else:
+        names = await asyncio.to_thread(load_item_suggestions, interaction.guild_id, current)
+    return [app_commands.Choice(name=name, value=name) for name in names]
+
+async def own_item_autocomplete(interaction: discord.Interaction, current: str):
+    items = await asyncio.to_thread(load_supplier_inventory, interaction.guild_id, interaction.user.id)
+    current = current.lower()
+    return [app_commands.Choice(name=f"#{item_id} - {name} (x{qty})", value=item_id)
+            for item_id, name, qty, price, desc in items
+            if current in name.lower() or current in str(item_id)][:25]
+
+def benchmark_state_engine(listings=20000, suppliers=200, repeat=50):
+    """python main.py bench [annunci]: memoria per annuncio e latenza di catalogo, inventario e
+    autocompletamento, stato in memoria contro query SQLite, su un database temporaneo"""
+    import random
+    import tracemalloc
+    
+    guild_id = 1
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            init_db()
+            conn = sqlite3.connect(MAIN_DB)
+            cursor = conn.cursor()
+            random.seed(0)
+            names = [f"Leftovers {n}" for n in range(max(1, listings // 10))]
+            cursor.executemany('INSERT INTO suppliers (guild_id, user_id, username, reputation) VALUES (?, ?, ?, ?)',
+                               [(guild_id, user_id, f"Fornitore{user_id}", round(random.uniform(1, 5), 2))
+                                for user_id in range(suppliers)])
+            rows = []
+            for _ in range(listings):
+                name = random.choice(names)
+                rows.append((guild_id, random.randrange(suppliers), name, normalize_item_name(name),
+                             random.randint(0, 50), random.randint(100, 100000), "Descrizione di prova"))
+            cursor.executemany('''
+                INSERT INTO inventory (guild_id, supplier_id, item_name, item_key, quantity, price, description)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+            conn.close()
+            
+            # Memoria: stato residente dell'engine contro le tuple allocate da un fetchall del catalogo
+            tracemalloc.start()
+            engine = StateEngine()
+            engine.load(MAIN_DB)
+            engine_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            engine.enabled = True
+            
+            tracemalloc.start()
+            sql_catalog = load_catalog_items(guild_id)
+            sql_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            
+            def measure(function, *args):
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    result = function(*args)
+                return (time.perf_counter() - started) / repeat * 1000, result
+            
+            supplier_id = rows[0][1]
+            checks = [
+                ("Catalogo (nome)", load_catalog_items, engine.catalog, (guild_id,)),
+                ("Catalogo (reputazione)", lambda *args: load_catalog_items(*args, 'reputazione'),
+                 lambda *args: engine.catalog(*args, 'reputazione'), (guild_id,)),
+                ("Inventario fornitore", load_supplier_inventory, engine.supplier_inventory, (guild_id, supplier_id)),
+                ("Autocompletamento", load_item_suggestions, engine.item_suggestions, (guild_id, "leftovers 1")),
+            ]
+            
+            print(f"🧪 {listings} annunci, {suppliers} fornitori, {repeat} ripetizioni")
+            print(f"🧠 Memoria per annuncio: engine {engine_bytes / listings:.0f} byte (residente), "
+                  f"SQL {sql_bytes / max(1, len(sql_catalog)):.0f} byte per riga del catalogo (per richiesta)")
+            for label, sql_function, engine_function, args in checks:
+                sql_ms, sql_result = measure(sql_function, *args)
+                engine_ms, engine_result = measure(engine_function, *args)
+                # A parità di chiave di ordinamento SQLite non garantisce l'ordine: confronto come insiemi
+                same = sorted(sql_result) == sorted(engine_result)
+                print(f"  {'✅' if same else '❌'} {label}: SQL {sql_ms:.2f} ms, engine {engine_ms:.2f} ms "
+                      f"({sql_ms / engine_ms if engine_ms else float('inf'):.1f}x), {len(engine_result)} righe")
+        finally:
+            os.chdir(previous_dir)
+            initialized_databases.discard(MAIN_DB)
 
 # Gruppo comandi fornitore
 class SupplierCommands(app_commands.Group):
     def __init__(self):
-        super().__init__(name='fornitore', description='Comandi per fornitori')
+        super().__init__(name='fornitore', description='Comandi per fornitori', guild_only=True)
 
     @app_commands.command(name='registra', description='Registrati come fornitore')
+    @deadline_guard()
     async def register_supplier(self, interaction: discord.Interaction):
-        conn = sqlite3.connect('pokemmo_marketplace.db')
+        conn = connect_db(interaction.guild_id)
         cursor = conn.cursor()
         
-        cursor.execute('INSERT OR REPLACE INTO suppliers (user_id, username) VALUES (?, ?)',
-                      (interaction.user.id, interaction.user.display_name))
+        # Upsert: una nuova registrazione non azzera i contatori della reputazione
+        cursor.execute('''
+            INSERT INTO suppliers (guild_id, user_id, username) VALUES (?, ?, ?)
+            ON CONFLICT (guild_id, user_id) DO UPDATE SET username = excluded.username, active = TRUE
+        ''', (interaction.guild_id, interaction.user.id, interaction.user.display_name))
         conn.commit()
+        state_engine.refresh(cursor, interaction.guild_id, suppliers=[interaction.user.id])
         conn.close()
         
         await interaction.response.send_message("✅ Ti sei registrato come fornitore!", ephemeral=True)
@@ -377,56 +2168,35 @@ class SupplierCommands(app_commands.Group):
     @app_commands.command(name='aggiungi', description='Aggiungi o aggiorna un oggetto nel tuo inventario')
     @app_commands.describe(
         nome="Nome dell'oggetto",
-        quantita="Quantità da aggiungere", 
+        quantita="Quantità da aggiungere (negativa per ridurre, 0 per cambiare solo il prezzo)",
         prezzo="Prezzo per unità",
         descrizione="Descrizione opzionale"
     )
+    @deadline_guard()
     async def add_item(self, interaction: discord.Interaction, nome: str, quantita: int, prezzo: int, descrizione: str = ""):
-        conn = sqlite3.connect('pokemmo_marketplace.db')
-        cursor = conn.cursor()
+        if prezzo <= 0:
+            await interaction.response.send_message("❌ Il prezzo deve essere maggiore di zero.", ephemeral=True)
+            return
         
-        # Verifica se è registrato come fornitore
-        cursor.execute('SELECT user_id FROM suppliers WHERE user_id = ?', (interaction.user.id,))
-        if not cursor.fetchone():
+        result = await asyncio.to_thread(save_inventory_item, interaction.guild_id, interaction.user.id,
+                                         interaction.user.display_name, nome, quantita, prezzo, descrizione)
+        if result is None:
             await interaction.response.send_message("❌ Devi prima registrarti come fornitore!", ephemeral=True)
-            conn.close()
+            return
+        if result is False:
+            await interaction.response.send_message("❌ Per un nuovo oggetto la quantità deve essere maggiore di zero.", ephemeral=True)
             return
         
-        # Controlla se l'oggetto esiste già per questo fornitore
-        cursor.execute('''
-            SELECT id, quantity, price, description 
-            FROM inventory 
-            WHERE supplier_id = ? AND LOWER(item_name) = LOWER(?)
-        ''', (interaction.user.id, nome))
-        
-        existing_item = cursor.fetchone()
-        
-        if existing_item:
-            # Oggetto esiste già - aggiorna quantità e prezzo
-            item_id, current_qty, current_price, current_desc = existing_item
-            new_quantity = current_qty + quantita
-            
-            cursor.execute('''
-                UPDATE inventory 
-                SET quantity = ?, price = ?, description = ?
-                WHERE id = ?
-            ''', (new_quantity, prezzo, descrizione or current_desc, item_id))
-            
+        current_qty, new_quantity = result
+        if current_qty is not None:
             embed = discord.Embed(
                 title="🔄 Oggetto aggiornato",
                 color=discord.Color.orange()
             )
             embed.add_field(name="Oggetto", value=nome, inline=True)
-            embed.add_field(name="Quantità", value=f"{current_qty} → {new_quantity} (+{quantita})", inline=True)
+            embed.add_field(name="Quantità", value=f"{current_qty} → {new_quantity} ({new_quantity - current_qty:+})", inline=True)
             embed.add_field(name="Prezzo", value=f"{prezzo:,} ¥", inline=True)
-            
         else:
-            # Nuovo oggetto - crea entry
-            cursor.execute('''
-                INSERT INTO inventory (supplier_id, item_name, quantity, price, description)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (interaction.user.id, nome, quantita, prezzo, descrizione))
-            
             embed = discord.Embed(
                 title="✅ Nuovo oggetto aggiunto",
                 color=discord.Color.green()
@@ -438,25 +2208,13 @@ class SupplierCommands(app_commands.Group):
         if descrizione:
             embed.add_field(name="Descrizione", value=descrizione, inline=False)
         
-        conn.commit()
-        conn.close()
-        
+        mark_showcase_dirty(interaction.guild_id)
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @app_commands.command(name='inventario', description='Visualizza il tuo inventario')
+    @deadline_guard()
     async def view_inventory(self, interaction: discord.Interaction):
-        conn = sqlite3.connect('pokemmo_marketplace.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, item_name, quantity, price, description 
-            FROM inventory 
-            WHERE supplier_id = ? AND quantity > 0
-            ORDER BY item_name
-        ''', (interaction.user.id,))
-        
-        items = cursor.fetchall()
-        conn.close()
+        items = await asyncio.to_thread(load_supplier_inventory, interaction.guild_id, interaction.user.id)
         
         if not items:
             await interaction.response.send_message("📦 Il tuo inventario è vuoto.", ephemeral=True)
@@ -486,56 +2244,104 @@ class SupplierCommands(app_commands.Group):
 
     @app_commands.command(name='rimuovi', description='Rimuovi un oggetto dal tuo inventario')
     @app_commands.describe(item_id="ID dell'oggetto da rimuovere")
+    @app_commands.autocomplete(item_id=own_item_autocomplete)
+    @deadline_guard()
     async def remove_item(self, interaction: discord.Interaction, item_id: int):
-        conn = sqlite3.connect('pokemmo_marketplace.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM inventory WHERE id = ? AND supplier_id = ?', 
-                      (item_id, interaction.user.id))
-        
-        if cursor.rowcount > 0:
-            conn.commit()
+        if await asyncio.to_thread(delete_inventory_item, interaction.guild_id, interaction.user.id, item_id):
+            mark_showcase_dirty(interaction.guild_id)
             await interaction.response.send_message(f"✅ Oggetto #{item_id} rimosso dall'inventario.", ephemeral=True)
         else:
             await interaction.response.send_message("❌ Oggetto non trovato o non autorizzato.", ephemeral=True)
+
+def reserve_best_price(guild_id, customer_id, oggetto, quantita, luogo, orario, by_reputation=False):
+    """Prenota la quantità dai fornitori più economici (o più affidabili) in un'unica transazione, in un thread.
+    Ritorna (ordini, quantità disponibile); ordini è None se la quantità non basta"""
+    conn = connect_db(guild_id)
+    cursor = conn.cursor()
+    
+    try:
+        # Blocca le scritture finché la prenotazione su tutte le righe non è completa
+        cursor.execute('BEGIN IMMEDIATE')
         
+        order_by = 's.reputation DESC, i.price, i.id' if by_reputation else 'i.price, i.id'
+        cursor.execute(f'''
+            SELECT i.id, i.supplier_id, i.item_name, i.quantity, i.price, s.username
+            FROM inventory i
+            JOIN suppliers s ON i.guild_id = s.guild_id AND i.supplier_id = s.user_id
+            WHERE i.guild_id = ? AND i.item_key = ? AND i.quantity > 0 AND i.supplier_id != ?
+            ORDER BY {order_by}
+        ''', (guild_id, normalize_item_name(oggetto), customer_id))
+        
+        allocations = []
+        remaining = quantita
+        for item_id, supplier_id, item_name, available_qty, price, supplier_name in cursor.fetchall():
+            take = min(remaining, available_qty)
+            allocations.append((item_id, supplier_id, item_name, take, price, supplier_name))
+            remaining -= take
+            if remaining == 0:
+                break
+        
+        if remaining > 0:
+            conn.rollback()
+            return None, quantita - remaining
+        
+        # Un ordine per ogni riga di inventario (cioè per fornitore)
+        orders = []
+        for item_id, supplier_id, item_name, take, price, supplier_name in allocations:
+            total_price = price * take
+            cursor.execute('''
+                INSERT INTO orders (guild_id, customer_id, supplier_id, item_id, quantity, total_price, location, delivery_time,
+                                    item_name, unit_price, supplier_name)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (guild_id, customer_id, supplier_id, item_id, take, total_price, luogo, orario,
+                  item_name, price, supplier_name))
+            order_id = cursor.lastrowid
+            
+            cursor.execute('UPDATE inventory SET quantity = quantity - ? WHERE id = ?', (take, item_id))
+            log_order_created(cursor, guild_id, order_id, customer_id, supplier_id, item_id, take, total_price)
+            orders.append((order_id, supplier_id, supplier_name, item_name, take, total_price))
+        
+        conn.commit()
+        state_engine.refresh(cursor, guild_id, items=[allocation[0] for allocation in allocations])
+        return orders, quantita
+    
+    except Exception:
+        conn.rollback()
+        raise
+    
+    finally:
         conn.close()
 
 # Gruppo comandi cliente
 class CustomerCommands(app_commands.Group):
     def __init__(self):
-        super().__init__(name='negozio', description='Comandi per acquisti')
+        super().__init__(name='negozio', description='Comandi per acquisti', guild_only=True)
 
     @app_commands.command(name='catalogo', description='Visualizza tutti gli oggetti disponibili')
-    async def view_catalog(self, interaction: discord.Interaction):
-        conn = sqlite3.connect('pokemmo_marketplace.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT i.id, i.item_name, i.quantity, i.price, i.description, s.username
-            FROM inventory i
-            JOIN suppliers s ON i.supplier_id = s.user_id
-            WHERE i.quantity > 0
-            ORDER BY i.item_name
-        ''')
-        
-        items = cursor.fetchall()
-        conn.close()
+    @app_commands.describe(ordina="Ordinamento (predefinito: nome)")
+    @app_commands.choices(ordina=[
+        app_commands.Choice(name='Nome', value='nome'),
+        app_commands.Choice(name='Prezzo', value='prezzo'),
+        app_commands.Choice(name='Reputazione fornitore', value='reputazione'),
+        app_commands.Choice(name='Per oggetto (totale e prezzo minimo)', value='oggetto'),
+    ])
+    @deadline_guard(ephemeral=False)
+    async def view_catalog(self, interaction: discord.Interaction, ordina: app_commands.Choice[str] = None):
+        order = ordina.value if ordina else 'nome'
+        if order == 'oggetto':
+            loader = lambda: build_market_embed(interaction.guild_id)
+        else:
+            loader = lambda: build_catalog_embed(interaction.guild_id, order)
+        embed, cached = await throttled_read(('catalogo', interaction.guild_id, order), interaction.user.id, loader)
         
-        if not items:
+        if embed is None:
             await interaction.response.send_message("🏪 Nessun oggetto disponibile al momento.", ephemeral=True)
             return
         
-        embed = discord.Embed(
-            title="🏪 Catalogo PokeMMO Marketplace",
-            color=discord.Color.gold()
-        )
-        
-        for item_id, name, qty, price, desc, supplier in items:
-            value = f"**Fornitore:** {supplier}\n**Disponibili:** {qty}\n**Prezzo:** {price:,} ¥"
-            if desc:
-                value += f"\n**Descrizione:** {desc}"
-            embed.add_field(name=f"#{item_id} - {name}", value=value, inline=False)
+        if cached:
+            # Utente oltre il limite: risposta dalla cache, solo per lui
+            await interaction.response.send_message("⏳ Catalogo recente (troppe richieste ravvicinate)", embed=embed, ephemeral=True)
+            return
         
         await interaction.response.send_message(embed=embed)
 
@@ -546,11 +2352,16 @@ class CustomerCommands(app_commands.Group):
         luogo="Luogo di consegna (es. Vermilion City)",
         orario="Orario preferito (es. 20:00 o domani sera)"
     )
+    @deadline_guard()
     async def place_order(self, interaction: discord.Interaction, item_id: int, quantita: int, luogo: str, orario: str):
         # IMPORTANTE: Risposta immediata per evitare timeout
         await interaction.response.defer(ephemeral=True)
         
-        conn = sqlite3.connect('pokemmo_marketplace.db')
+        if quantita <= 0:
+            await interaction.followup.send("❌ La quantità deve essere maggiore di zero.", ephemeral=True)
+            return
+        
+        conn = connect_db(interaction.guild_id)
         cursor = conn.cursor()
         
         try:
@@ -558,9 +2369,9 @@ class CustomerCommands(app_commands.Group):
             cursor.execute('''
                 SELECT i.supplier_id, i.item_name, i.quantity, i.price, s.username
                 FROM inventory i
-                JOIN suppliers s ON i.supplier_id = s.user_id
-                WHERE i.id = ?
-            ''', (item_id,))
+                JOIN suppliers s ON i.guild_id = s.guild_id AND i.supplier_id = s.user_id
+                WHERE i.guild_id = ? AND i.id = ? AND i.deleted_at IS NULL
+            ''', (interaction.guild_id, item_id))
             
             item_data = cursor.fetchone()
             if not item_data:
@@ -579,22 +2390,33 @@ class CustomerCommands(app_commands.Group):
             
             total_price = price * quantita
             
+            # Prenota la quantità in modo atomico: un ordine concorrente (anche da un altro shard)
+            # può aver consumato lo stock dopo la lettura
+            cursor.execute('UPDATE inventory SET quantity = quantity - ? WHERE id = ? AND quantity >= ?',
+                          (quantita, item_id, quantita))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                await interaction.followup.send("❌ Quantità non più disponibile. Riprova.", ephemeral=True)
+                return
+            
             # Crea ordine
             cursor.execute('''
-                INSERT INTO orders (customer_id, supplier_id, item_id, quantity, total_price, location, delivery_time)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (interaction.user.id, supplier_id, item_id, quantita, total_price, luogo, orario))
+                INSERT INTO orders (guild_id, customer_id, supplier_id, item_id, quantity, total_price, location, delivery_time,
+                                    item_name, unit_price, supplier_name)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (interaction.guild_id, interaction.user.id, supplier_id, item_id, quantita, total_price, luogo, orario,
+                  item_name, price, supplier_name))
             
             order_id = cursor.lastrowid
-            
-            # Aggiorna inventario
-            cursor.execute('UPDATE inventory SET quantity = quantity - ? WHERE id = ?', (quantita, item_id))
+            log_order_created(cursor, interaction.guild_id, order_id, interaction.user.id, supplier_id, item_id, quantita, total_price)
             
             conn.commit()
+            state_engine.refresh(cursor, interaction.guild_id, items=[item_id])
+            mark_showcase_dirty(interaction.guild_id)
             
             # Invia notifica al fornitore CON BOTTONI
             dm_sent, dm_error = await send_supplier_notification_with_buttons(
-                order_id, supplier_id, supplier_name, item_name, 
+                interaction.guild_id, order_id, supplier_id, supplier_name, item_name, 
                 quantita, total_price, luogo, orario, interaction.user
             )
             
@@ -621,7 +2443,7 @@ class CustomerCommands(app_commands.Group):
                 embed.set_footer(text="Notifica DM fallita - contatto manuale necessario")
             
             # Aggiungi bottone annulla per il cliente
-            view = CustomerOrderView(order_id, supplier_id)
+            view = CustomerOrderView(order_id, supplier_id, interaction.guild_id)
             
             await interaction.followup.send(embed=embed, view=view, ephemeral=True)
             print(f"✅ DEBUG: Conferma ordine con bottoni inviata al cliente {interaction.user.display_name}")
@@ -639,21 +2461,88 @@ class CustomerCommands(app_commands.Group):
             cursor.close()
             conn.close()
 
+    @app_commands.command(name='compra', description='Compra un oggetto dai fornitori più economici')
+    @app_commands.describe(
+        oggetto="Nome dell'oggetto da comprare",
+        quantita="Quantità totale da comprare",
+        luogo="Luogo di consegna (es. Vermilion City)",
+        orario="Orario preferito (es. 20:00 o domani sera)",
+        ordina="Fornitori da preferire (predefinito: prezzo più basso)"
+    )
+    @app_commands.choices(ordina=[
+        app_commands.Choice(name='Prezzo', value='prezzo'),
+        app_commands.Choice(name='Reputazione fornitore', value='reputazione'),
+    ])
+    @app_commands.autocomplete(oggetto=item_name_autocomplete)
+    @deadline_guard()
+    async def buy_best_price(self, interaction: discord.Interaction, oggetto: str, quantita: int, luogo: str, orario: str,
+                             ordina: app_commands.Choice[str] = None):
+        await interaction.response.defer(ephemeral=True)
+        
+        if quantita <= 0:
+            await interaction.followup.send("❌ La quantità deve essere maggiore di zero.", ephemeral=True)
+            return
+        
+        try:
+            by_reputation = ordina is not None and ordina.value == 'reputazione'
+            orders, available = await asyncio.to_thread(reserve_best_price, interaction.guild_id, interaction.user.id,
+                                                        oggetto, quantita, luogo, orario, by_reputation)
+            if orders is None:
+                await interaction.followup.send(
+                    f"❌ Quantità non disponibile per **{oggetto}**. Disponibili: {available}",
+                    ephemeral=True
+                )
+                return
+            
+            mark_showcase_dirty(interaction.guild_id)
+            
+            embed = discord.Embed(
+                title="✅ Acquisto confermato!",
+                description=f"{oggetto} x{quantita} da {len(orders)} fornitore/i",
+                color=discord.Color.green(),
+                timestamp=datetime.now()
+            )
+            
+            for order_id, supplier_id, supplier_name, item_name, take, total_price in orders:
+                dm_sent, dm_error = await send_supplier_notification_with_buttons(
+                    interaction.guild_id, order_id, supplier_id, supplier_name, item_name,
+                    take, total_price, luogo, orario, interaction.user
+                )
+                
+                value = f"**Fornitore:** {supplier_name}\n**Quantità:** {take}\n**Totale:** {total_price:,} ¥"
+                if dm_sent:
+                    value += "\n📨 Fornitore notificato via DM"
+                else:
+                    value += f"\n❌ DM non inviato: contatta <@{supplier_id}>"
+                embed.add_field(name=f"Ordine #{order_id}", value=value, inline=False)
+            
+            grand_total = sum(order[5] for order in orders)
+            embed.add_field(name="💰 Totale", value=f"{grand_total:,} ¥", inline=False)
+            embed.set_footer(text="Gestisci o annulla i singoli ordini con /negozio ordini")
+            
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            
+        except Exception as e:
+            print(f"❌ DEBUG: Errore generale nel comando compra: {e}")
+            try:
+                await interaction.followup.send("❌ Errore durante l'acquisto. Riprova.", ephemeral=True)
+            except:
+                pass
+
     @app_commands.command(name='ordini', description='Visualizza i tuoi ordini con opzioni di gestione')
+    @deadline_guard()
     async def view_orders(self, interaction: discord.Interaction):
-        conn = sqlite3.connect('pokemmo_marketplace.db')
+        conn = connect_db(interaction.guild_id)
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT o.id, i.item_name, o.quantity, o.total_price, o.location, 
-                   o.delivery_time, o.status, s.username, o.created_at, o.supplier_id
-            FROM orders o
-            JOIN inventory i ON o.item_id = i.id
-            JOIN suppliers s ON o.supplier_id = s.user_id
-            WHERE o.customer_id = ?
-            ORDER BY o.created_at DESC
+            SELECT id, item_name, quantity, total_price, location, 
+                   delivery_time, status, supplier_name, created_at, supplier_id
+            FROM orders
+            WHERE guild_id = ? AND customer_id = ?
+            ORDER BY created_at DESC
             LIMIT 10
-        ''', (interaction.user.id,))
+        ''', (interaction.guild_id, interaction.user.id))
         
         orders = cursor.fetchall()
         conn.close()
@@ -683,7 +2572,7 @@ class CustomerCommands(app_commands.Group):
             embed.add_field(name="Status", value="⏳ In attesa", inline=True)
             embed.set_footer(text="Puoi annullare questo ordine usando il bottone sotto")
             
-            view = CustomerOrderView(order_id, supplier_id)
+            view = CustomerOrderView(order_id, supplier_id, interaction.guild_id)
             embeds.append(embed)
             views.append(view)
         
@@ -726,37 +2615,132 @@ class CustomerCommands(app_commands.Group):
                 ephemeral=True
             )
 
+    @app_commands.command(name='desidero', description='Ricevi un avviso quando un oggetto viene messo in vendita')
+    @app_commands.describe(
+        oggetto="Nome dell'oggetto desiderato",
+        prezzo_max="Prezzo massimo per unità (opzionale)",
+        rimuovi="Smetti di ricevere avvisi per questo oggetto"
+    )
+    @deadline_guard()
+    async def add_wishlist(self, interaction: discord.Interaction, oggetto: str, prezzo_max: int = None, rimuovi: bool = False):
+        conn = connect_db(interaction.guild_id)
+        cursor = conn.cursor()
+        
+        if rimuovi:
+            cursor.execute('DELETE FROM wishlists WHERE guild_id = ? AND user_id = ? AND item_key = ?',
+                          (interaction.guild_id, interaction.user.id, normalize_item_name(oggetto)))
+            removed = cursor.rowcount > 0
+            conn.commit()
+            conn.close()
+            if removed:
+                await interaction.response.send_message(f"🔕 Non riceverai più avvisi per **{oggetto}**.", ephemeral=True)
+            else:
+                await interaction.response.send_message(f"❌ Nessun avviso attivo per **{oggetto}**.", ephemeral=True)
+            return
+        
+        # Una sola richiesta per utente e oggetto: una nuova sostituisce il prezzo massimo
+        cursor.execute('''
+            INSERT INTO wishlists (guild_id, user_id, item_key, item_name, max_price)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (guild_id, user_id, item_key) DO UPDATE SET
+                item_name = excluded.item_name,
+                max_price = excluded.max_price
+        ''', (interaction.guild_id, interaction.user.id, normalize_item_name(oggetto), oggetto, prezzo_max))
+        conn.commit()
+        conn.close()
+        
+        limit = f" a massimo {prezzo_max:,} ¥" if prezzo_max is not None else ""
+        await interaction.response.send_message(
+            f"🔔 Riceverai un DM quando **{oggetto}** sarà disponibile{limit}.",
+            ephemeral=True
+        )
+
+    @app_commands.command(name='desideri', description='Visualizza gli avvisi attivi')
+    @deadline_guard()
+    async def list_wishlists(self, interaction: discord.Interaction):
+        conn = connect_db(interaction.guild_id)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT item_name, max_price FROM wishlists
+            WHERE guild_id = ? AND user_id = ?
+            ORDER BY item_key
+        ''', (interaction.guild_id, interaction.user.id))
+        wishes = cursor.fetchall()
+        conn.close()
+        
+        if not wishes:
+            await interaction.response.send_message("📭 Nessun avviso attivo. Usa `/negozio desidero` per crearne uno.", ephemeral=True)
+            return
+        
+        embed = discord.Embed(title="🔔 I tuoi avvisi", color=discord.Color.blue())
+        embed.description = "\n".join(
+            f"• **{item_name}**" + (f" (max {max_price:,} ¥)" if max_price is not None else "")
+            for item_name, max_price in wishes[:50]
+        )
+        embed.set_footer(text="Rimuovi un avviso con /negozio desidero rimuovi:True")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name='prezzi', description='Indice prezzi di mercato di un oggetto')
+    @app_commands.describe(oggetto="Nome dell'oggetto")
+    @app_commands.autocomplete(oggetto=item_name_autocomplete)
+    @deadline_guard()
+    async def view_prices(self, interaction: discord.Interaction, oggetto: str):
+        conn = connect_db(interaction.guild_id)
+        cursor = conn.cursor()
+
+        # Legge solo gli aggregati precalcolati (ultima fascia per periodo), mai lo storico
+        item_key = normalize_item_name(oggetto)
+        rollups = {}
+        for period in PRICE_PERIODS:
+            cursor.execute('''
+                SELECT item_name, bucket_start, min_price, median_price, last_price, volume, trades
+                FROM price_rollups
+                WHERE guild_id = ? AND item_key = ? AND period = ?
+                ORDER BY bucket_start DESC
+                LIMIT 1
+            ''', (interaction.guild_id, item_key, period))
+            row = cursor.fetchone()
+            if row:
+                rollups[period] = row
+
+        conn.close()
+
+        if not rollups:
+            await interaction.response.send_message(f"📈 Nessun dato di prezzo per **{oggetto}**.", ephemeral=True)
+            return
+
+        item_name = next(iter(rollups.values()))[0]
+        embed = discord.Embed(
+            title=f"📈 Prezzi di mercato - {item_name}",
+            color=discord.Color.gold()
+        )
+
+        period_labels = {'hour': "Ora", 'day': "Giorno", 'week': "Settimana"}
+        for period, (_, bucket_start, min_price, median_price, last_price, volume, trades) in rollups.items():
+            value = (f"**Minimo:** {min_price:,} ¥\n"
+                     f"**Mediana:** {median_price:,} ¥\n"
+                     f"**Ultimo:** {last_price:,} ¥\n"
+                     f"**Volume:** {volume} ({trades} scambi)")
+            embed.add_field(name=f"{period_labels[period]} dal <t:{bucket_start}:f>", value=value, inline=True)
+
+        embed.set_footer(text="Include prezzi di listino e ordini confermati")
+
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
 # Registra i gruppi di comandi
 bot.tree.add_command(SupplierCommands())
 bot.tree.add_command(CustomerCommands())
 
 # Comando per fornitori per vedere i loro ordini ricevuti
 @bot.tree.command(name='ordini_ricevuti', description='[FORNITORI] Visualizza ordini ricevuti dai clienti')
+@app_commands.guild_only()
+@deadline_guard()
 async def view_received_orders(interaction: discord.Interaction):
-    conn = sqlite3.connect('pokemmo_marketplace.db')
-    cursor = conn.cursor()
-    
-    # Verifica che sia un fornitore registrato
-    cursor.execute('SELECT user_id FROM suppliers WHERE user_id = ?', (interaction.user.id,))
-    if not cursor.fetchone():
+    orders = await asyncio.to_thread(load_received_orders, interaction.guild_id, interaction.user.id)
+    if orders is None:
         await interaction.response.send_message("❌ Devi essere registrato come fornitore!", ephemeral=True)
-        cursor.close()
-        conn.close()
         return
     
-    cursor.execute('''
-        SELECT o.id, i.item_name, o.quantity, o.total_price, o.location, 
-               o.delivery_time, o.status, o.created_at, o.customer_id
-        FROM orders o
-        JOIN inventory i ON o.item_id = i.id
-        WHERE o.supplier_id = ?
-        ORDER BY o.created_at DESC
-        LIMIT 15
-    ''', (interaction.user.id,))
-    
-    orders = cursor.fetchall()
-    conn.close()
-    
     if not orders:
         await interaction.response.send_message("📝 Non hai ancora ricevuto ordini.", ephemeral=True)
         return
@@ -828,27 +2812,34 @@ async def view_received_orders(interaction: discord.Interaction):
 
 # Comandi di amministrazione
 @bot.tree.command(name='stats', description='Statistiche del marketplace')
+@app_commands.guild_only()
 @app_commands.default_permissions(administrator=True)
+@deadline_guard(ephemeral=False)  # la risposta è pubblica, tranne quando arriva dalla cache
 async def marketplace_stats(interaction: discord.Interaction):
-    conn = sqlite3.connect('pokemmo_marketplace.db')
+    embed, cached = await throttled_read(('stats', interaction.guild_id), interaction.user.id,
+                                         lambda: build_stats_embed(interaction.guild_id))
+    await interaction.response.send_message(embed=embed, ephemeral=cached)
+
+def build_stats_embed(guild_id):
+    conn = connect_db(guild_id)
     cursor = conn.cursor()
     
-    cursor.execute('SELECT COUNT(*) FROM suppliers')
+    cursor.execute('SELECT COUNT(*) FROM suppliers WHERE guild_id = ?', (guild_id,))
     total_suppliers = cursor.fetchone()[0]
     
-    cursor.execute('SELECT COUNT(*) FROM inventory WHERE quantity > 0')
+    cursor.execute('SELECT COUNT(*) FROM inventory WHERE guild_id = ? AND quantity > 0', (guild_id,))
     total_items = cursor.fetchone()[0]
     
-    cursor.execute('SELECT COUNT(*) FROM orders')
+    cursor.execute('SELECT COUNT(*) FROM orders WHERE guild_id = ?', (guild_id,))
     total_orders = cursor.fetchone()[0]
     
-    cursor.execute('SELECT SUM(total_price) FROM orders')
+    cursor.execute('SELECT SUM(total_price) FROM orders WHERE guild_id = ?', (guild_id,))
     total_volume = cursor.fetchone()[0] or 0
     
-    cursor.execute('SELECT COUNT(*) FROM orders WHERE status = \'pending\'')
+    cursor.execute('SELECT COUNT(*) FROM orders WHERE guild_id = ? AND status = \'pending\'', (guild_id,))
     pending_orders = cursor.fetchone()[0]
     
-    cursor.execute('SELECT COUNT(*) FROM orders WHERE status = \'completed\'')
+    cursor.execute('SELECT COUNT(*) FROM orders WHERE guild_id = ? AND status = \'completed\'', (guild_id,))
     completed_orders = cursor.fetchone()[0]
     
     conn.close()
@@ -864,10 +2855,129 @@ async def marketplace_stats(interaction: discord.Interaction):
     embed.add_field(name="Ordini completati", value=completed_orders, inline=True)
     embed.add_field(name="Volume scambi", value=f"{total_volume:,} ¥", inline=True)
     
-    await interaction.response.send_message(embed=embed)
+    if startup_metrics['connect_to_ready'] is not None:
+        embed.add_field(
+            name="⏱️ Avvio",
+            value=f"Connessione → pronto: {startup_metrics['connect_to_ready']:.2f}s (shard {startup_metrics['connect_shard']})\n"
+                  f"Comandi: {startup_metrics['command_sync']}",
+            inline=False
+        )
+    
+    embed.add_field(
+        name="⌛ Scadenze interazioni",
+        value=f"Risposte: {deadline_metrics['responded']} · Defer automatici: {deadline_metrics['deferred']}\n"
+              f"Quasi scadute: {deadline_metrics['near_miss']} · Scadute: {deadline_metrics['missed']}",
+        inline=False
+    )
+    
+    return embed
+
+@bot.tree.command(name='vetrina', description='Configura il catalogo sempre aggiornato in un canale')
+@app_commands.guild_only()
+@app_commands.describe(canale="Canale della vetrina (vuoto per disattivarla)")
+@app_commands.default_permissions(administrator=True)
+@deadline_guard()
+async def configure_showcase(interaction: discord.Interaction, canale: discord.TextChannel = None):
+    if interaction.guild_id is None:
+        await interaction.response.send_message("❌ Comando disponibile solo in un server.", ephemeral=True)
+        return
+    
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    if canale is None:
+        cursor.execute('DELETE FROM showcases WHERE guild_id = ?', (interaction.guild_id,))
+        message = "🏪 Vetrina disattivata."
+    else:
+        # Nuovo canale: i messaggi vengono ricreati al prossimo aggiornamento
+        cursor.execute('''
+            INSERT INTO showcases (guild_id, channel_id, message_ids) VALUES (?, ?, '[]')
+            ON CONFLICT (guild_id) DO UPDATE SET channel_id = excluded.channel_id, message_ids = '[]'
+        ''', (interaction.guild_id, canale.id))
+        message = f"🏪 Vetrina attivata in {canale.mention}: si aggiornerà ad ogni modifica dell'inventario."
+    
+    conn.commit()
+    conn.close()
+    
+    showcase_state['last_pages'].pop(interaction.guild_id, None)
+    mark_showcase_dirty(interaction.guild_id)
+    await interaction.response.send_message(message, ephemeral=True)
+
+@bot.tree.command(name='backup', description='Esegue subito un backup del database')
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+@deadline_guard()
+async def backup_command(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+    
+    # Il database condiviso contiene tutte le gilde: solo il proprietario del bot può copiarlo
+    if not PER_GUILD_DB and not await bot.is_owner(interaction.user):
+        await interaction.followup.send("❌ Il database è condiviso tra più server: solo il proprietario del bot può eseguirne il backup.", ephemeral=True)
+        return
+    
+    try:
+        path, size, ok, detail = await backup_database(db_path(interaction.guild_id), manual=True)
+    except Exception as e:
+        print(f"❌ Errore backup manuale: {e}")
+        await interaction.followup.send(f"❌ Errore durante il backup: {e}", ephemeral=True)
+        return
+    
+    if ok:
+        await interaction.followup.send(f"✅ Backup completato e verificato: `{os.path.basename(path)}` ({size:,} byte)", ephemeral=True)
+    else:
+        await interaction.followup.send(f"❌ Backup `{os.path.basename(path)}` non valido: {detail}", ephemeral=True)
+
+@bot.tree.command(name='verifica_coerenza', description='Controlla inventario e ordini e ne corregge le anomalie')
+@app_commands.describe(correggi="Applica le correzioni (predefinito: solo controllo)")
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+@deadline_guard()
+async def verify_consistency(interaction: discord.Interaction, correggi: bool = False):
+    await interaction.response.defer(ephemeral=True)
+    
+    path = db_path(interaction.guild_id)
+    anomalies = await run_verifier(path, correggi, interaction.guild_id)
+    fixed = sum(1 for anomaly in anomalies if anomaly[2])
+    
+    embed = discord.Embed(
+        title="🩺 Verifica coerenza" + ("" if correggi else " (solo controllo)"),
+        color=discord.Color.green() if not anomalies else discord.Color.orange(),
+        description=f"{len(anomalies)} anomalie trovate, {fixed} corrette"
+    )
+    if anomalies:
+        lines = [("✅ " if was_fixed else "⚠️ ") + detail for _, detail, was_fixed in anomalies[:15]]
+        embed.add_field(name="Anomalie", value="\n".join(lines)[:1024], inline=False)
+    
+    if path in verify_reports:
+        checked_at, report = verify_reports[path]
+        found = sum(1 for anomaly in report if anomaly[0] == interaction.guild_id)
+        mode = "correzione automatica" if VERIFY_AUTOFIX else "solo segnalazione"
+        embed.add_field(name="Controllo automatico", value=f"<t:{checked_at}:R>: {found} anomalie ({mode})", inline=False)
+    
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name='eventi_verifica', description='Ricostruisce inventario e ordini dal log eventi e li confronta')
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+@deadline_guard()
+async def verify_event_log(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+    
+    events, diffs = await asyncio.to_thread(replay_events, db_path(interaction.guild_id), interaction.guild_id)
+    
+    embed = discord.Embed(
+        title="🧾 Replay log eventi",
+        color=discord.Color.green() if not diffs else discord.Color.red(),
+        description=f"{events:,} eventi rielaborati, {len(diffs)} differenze"
+    )
+    if diffs:
+        embed.add_field(name="Differenze", value="\n".join(diffs[:15])[:1024], inline=False)
+    
+    await interaction.followup.send(embed=embed, ephemeral=True)
 
 # Comando di aiuto
 @bot.tree.command(name='aiuto', description='Mostra tutti i comandi disponibili')
+@deadline_guard(ephemeral=False)
 async def help_command(interaction: discord.Interaction):
     embed = discord.Embed(
         title="🎮 PokeMMO Marketplace Bot - Guida",
@@ -890,9 +3000,13 @@ async def help_command(interaction: discord.Interaction):
     embed.add_field(
         name="🛒 Comandi Cliente",
         value=(
-            "`/negozio catalogo` - Visualizza tutti gli oggetti\n"
+            "`/negozio catalogo` - Visualizza tutti gli oggetti (per nome, prezzo o reputazione)\n"
             "`/negozio ordina` - Effettua un ordine **con bottoni!**\n"
-            "`/negozio ordini` - **NUOVO!** Gestisci i tuoi ordini"
+            "`/negozio compra` - Compra al miglior prezzo tra più fornitori\n"
+            "`/negozio ordini` - **NUOVO!** Gestisci i tuoi ordini\n"
+            "`/negozio prezzi` - Indice prezzi di mercato di un oggetto\n"
+            "`/negozio desidero` - Avviso quando un oggetto è disponibile\n"
+            "`/negozio desideri` - Visualizza i tuoi avvisi"
         ),
         inline=False
     )
@@ -925,6 +3039,7 @@ async def help_command(interaction: discord.Interaction):
 # Comando per testare DM
 @bot.tree.command(name='test_dm', description='Testa invio DM a un utente')
 @app_commands.describe(user_id="ID Discord dell'utente da testare")
+@deadline_guard()
 async def test_dm(interaction: discord.Interaction, user_id: str):
     await interaction.response.defer(ephemeral=True)
     
@@ -979,6 +3094,7 @@ async def test_dm(interaction: discord.Interaction, user_id: str):
 
 # Comando per ottenere il proprio ID
 @bot.tree.command(name='mio_id', description='Ottieni il tuo ID Discord')
+@deadline_guard()
 async def get_my_id(interaction: discord.Interaction):
     await interaction.response.send_message(
         f"🆔 Il tuo ID Discord è: `{interaction.user.id}`\n"
@@ -992,8 +3108,43 @@ async def get_my_id(interaction: discord.Interaction):
 async def on_connect():
     print("🔗 Bot connesso a Discord!")
 
+# Tempo connessione → pronto misurato per shard: una riconnessione che riprende la sessione
+# (RESUME) non riceve READY, quindi la sua misura viene scartata
+@bot.event
+async def on_shard_connect(shard_id):
+    startup_metrics['connect_started'][shard_id] = time.monotonic()
+
+@bot.event
+async def on_shard_ready(shard_id):
+    started = startup_metrics['connect_started'].pop(shard_id, None)
+    if started is not None:
+        startup_metrics['connect_to_ready'] = time.monotonic() - started
+        startup_metrics['connect_shard'] = shard_id
+        print(f"⏱️ Shard {shard_id}: connessione → pronto in {startup_metrics['connect_to_ready']:.2f}s")
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    startup_metrics['connect_started'].pop(shard_id, None)
+
 # Avvia il bot
 if __name__ == "__main__":
+    # python main.py replay: confronta il log eventi con le tabelle senza avviare il bot
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        init_db()
+        all_diffs = []
+        for path in database_paths():
+            events, diffs = replay_events(path)
+            print(f"🧾 {path}: {events} eventi rielaborati, {len(diffs)} differenze")
+            for diff in diffs:
+                print(f"  - {diff}")
+            all_diffs.extend(diffs)
+        sys.exit(1 if all_diffs else 0)
+    
+    # python main.py bench [annunci]: confronto tra stato in memoria e query SQLite
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark_state_engine(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+        sys.exit(0)
+    
     # Prende il token dalle variabili d'ambiente
     TOKEN = os.getenv('DISCORD_TOKEN')
     if not TOKEN: